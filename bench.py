@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Copyright © 2021 Mark Summerfield. All rights reserved.
+# License: GPLv3
+
+import base64
+import datetime
+import gc
+import json
+import os
+import pathlib
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import oddl
+
+
+def main():
+    sizes, kinds, repeats, outfile, compare = get_config()
+    results = []
+    print(f'{"corpus":8} {"size":>10} {"structures":>10} {"operation":9} '
+          f'{"seconds":>9} {"MB/s":>8} {"structures/s":>13} '
+          f'{"peak MB":>8}')
+    for size in sizes:
+        for kind in kinds:
+            text = generate(kind, size)
+            for result in measure(kind, text, repeats):
+                results.append(result)
+                report(result)
+    data = dict(version=oddl.__version__, python=platform.python_version(),
+                numpy=oddl.numpy is not None, platform=platform.platform(),
+                date=datetime.datetime.now().isoformat(timespec='seconds'),
+                repeats=repeats, results=results)
+    if outfile is not None:
+        with open(outfile, 'wt', encoding='utf-8') as file:
+            json.dump(data, file, indent=1)
+            file.write('\n')
+        print(f'saved {outfile}')
+    if compare is not None:
+        compare_results(compare, results)
+
+
+def get_config():
+    if len(sys.argv) > 1 and sys.argv[1] in {'h', 'help', '-h', '--help'}:
+        raise SystemExit(f'''\
+usage: {pathlib.Path(sys.argv[0]).name} [-k KINDS] [-r N] [-o OUT.json] \
+[-c OLD.json] [SIZE1 [SIZE2 ...]]
+
+Generates OpenGEX-like corpora of each SIZE (in MB, default 1) and
+measures loads, dumps, save, and check throughput and peak memory.
+
+k KINDS   : comma-separated corpora from {",".join(KINDS)} (default all).
+r N       : time the best of N runs of each operation (default 3).
+o OUT     : write the results as JSON to OUT.
+c OLD     : compare the results with those saved in OLD (e.g., by an
+            earlier version) showing the speedup (>1 is faster).
+
+Letter options may be prefixed by - e.g., -r 5.
+''')
+    sizes = []
+    kinds = list(KINDS)
+    repeats = 3
+    outfile = compare = None
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0).lstrip('-')
+        if arg in {'k', 'r', 'o', 'c'}:
+            if not args:
+                raise SystemExit(f'missing value for {arg}')
+            value = args.pop(0)
+            if arg == 'k':
+                kinds = value.split(',')
+                for kind in kinds:
+                    if kind not in KINDS:
+                        raise SystemExit(f'unknown corpus: {kind!r}')
+            elif arg == 'r':
+                if not value.isdecimal() or int(value) < 1:
+                    raise SystemExit(f'invalid repeats: {value!r}')
+                repeats = int(value)
+            elif arg == 'o':
+                outfile = value
+            else:
+                compare = value
+        else:
+            try:
+                sizes.append(max(1, int(float(arg) * 1_000_000)))
+            except ValueError:
+                raise SystemExit(f'invalid size: {arg!r}')
+    return sizes or [1_000_000], kinds, repeats, outfile, compare
+
+
+def generate(kind, size, seed=1):
+    # Returns OpenDDL text of about size bytes; the same kind, size, and
+    # seed always produce the same text
+    rand = random.Random(seed)
+    parts = ['Metric (key = "distance") {float {0.01}}\n'
+             'Metric (key = "up") {string {"z"}}\n']
+    total = len(parts[0])
+    make = {'mesh': make_mesh, 'deep': make_deep, 'wide': make_wide,
+            'blob': make_blob}[kind]
+    i = 0
+    while total < size:
+        part = make(rand, i)
+        parts.append(part)
+        total += len(part)
+        i += 1
+    return ''.join(parts)
+
+
+def make_mesh(rand, i):
+    # Big float[3] vertex and uint32[3] index arrays
+    count = rand.randint(100, 2000)
+    vertices = ', '.join(
+        f'{{{rand.uniform(-100, 100):.6f}, {rand.uniform(-100, 100):.6f}, '
+        f'{rand.uniform(-100, 100):.6f}}}' for _ in range(count))
+    triangles = ', '.join(
+        f'{{{rand.randrange(count)}, {rand.randrange(count)}, '
+        f'{rand.randrange(count)}}}' for _ in range(count))
+    return f'''
+GeometryNode $node{i}
+{{
+    Name {{string {{"Node{i}"}}}}
+    ObjectRef {{ref {{$geometry{i}}}}}
+    Transform
+    {{
+        float[16] {{{{1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0,
+                     0.0, 0.0, 1.0, 0.0, {i}.0, 0.0, 0.0, 1.0}}}}
+    }}
+}}
+
+GeometryObject $geometry{i} // {count}
+{{
+    Mesh (primitive = "triangles")
+    {{
+        VertexArray (attrib = "position")
+        {{
+            float[3] {{{vertices}}}
+        }}
+        IndexArray
+        {{
+            uint32[3] {{{triangles}}}
+        }}
+    }}
+}}
+'''
+
+
+def make_deep(rand, i):
+    # Deep node hierarchies of small structures
+    depth = rand.randint(10, 40)
+    lines = [f'Node $deep{i}\n{{\n']
+    for level in range(depth):
+        indent = '    ' * (level + 1)
+        lines.append(f'{indent}Node %n{level} (level = {level})\n'
+                     f'{indent}{{\n{indent}    Name {{string {{"n{level}"}}}}'
+                     f'\n{indent}    Transform {{float[3] {{{{'
+                     f'{rand.random():.4f}, 0.0, 1.0}}}}}}\n')
+    for level in reversed(range(depth)):
+        lines.append(f'{"    " * (level + 1)}}}\n')
+    lines.append('}\n')
+    return ''.join(lines)
+
+
+def make_wide(rand, i):
+    # Structures with wide property lists
+    count = rand.randint(10, 60)
+    properties = ', '.join(
+        f'p{j} = {rand.choice(WIDE_VALUES)}' for j in range(count))
+    return f'Material $material{i} ({properties})\n{{\n' \
+           f'    Color (attrib = "diffuse") {{float[3] {{{{0.0, 0.5, ' \
+           f'{rand.random():.4f}}}}}}}\n}}\n'
+
+
+def make_blob(rand, i):
+    # Long strings and base64 blobs
+    text = ' '.join(rand.choice(WORDS) for _ in range(rand.randint(50, 500)))
+    data = bytes(rand.getrandbits(8)
+                 for _ in range(rand.randint(100, 5000))) # randbytes() is 3.9+
+    data = base64.b64encode(data).decode('ascii')
+    return f'''
+Texture $texture{i} (attrib = "diffuse")
+{{
+    string {{"{text}"}}
+    base64 {{{data}}}
+}}
+'''
+
+
+def measure(kind, text, repeats):
+    size = len(text.encode('utf-8'))
+    doc = oddl.Oddl()
+    doc.loads(text)
+    structures = sum(1 for structure in doc.structures
+                     for _ in structure.iterevents({'start'}))
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'bench.oddl')
+        operations = (('loads', lambda: doc.loads(text)),
+                      ('dumps', doc.dumps),
+                      ('save', lambda: doc.save(filename)),
+                      ('check', doc.check))
+        for operation, function in operations:
+            secs = best_time(function, repeats)
+            yield dict(corpus=kind, size=size, structures=structures,
+                       operation=operation, seconds=secs,
+                       mb_per_s=size / secs / 1e6,
+                       structures_per_s=structures / secs,
+                       peak_memory=peak_memory(function))
+
+
+def best_time(function, repeats):
+    secs = None
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        if secs is None or elapsed < secs:
+            secs = elapsed
+    return secs
+
+
+def peak_memory(function):
+    # Measured in its own run since tracing slows everything down
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def report(result, speedup=''):
+    print(f'{result["corpus"]:8} {result["size"]:10,} '
+          f'{result["structures"]:10,} {result["operation"]:9} '
+          f'{result["seconds"]:9.4f} {result["mb_per_s"]:8.2f} '
+          f'{result["structures_per_s"]:13,.0f} '
+          f'{result["peak_memory"] / 1e6:8.1f}{speedup}')
+
+
+def compare_results(filename, results):
+    with open(filename, encoding='utf-8') as file:
+        old = json.load(file)
+    seconds = {(result['corpus'], result['size'], result['operation']):
+               result['seconds'] for result in old['results']}
+    print(f'\ncompared with {old["version"]} ({old["date"]}):')
+    for result in results:
+        secs = seconds.get((result['corpus'], result['size'],
+                            result['operation']))
+        if secs is not None:
+            report(result, f' {secs / result["seconds"]:6.2f}x')
+
+
+KINDS = ('mesh', 'deep', 'wide', 'blob')
+WIDE_VALUES = ('true', 'false', '42', '-7', '0x1F', '3.5', '1e-3',
+               '"text"', '"a \\"quoted\\" value"', '$material0', 'null',
+               'float', 'uint8')
+WORDS = ('vertex', 'normal', 'tangent', 'bitangent', 'texcoord', 'color',
+         'diffuse', 'specular', 'emission', 'opacity', 'transparency',
+         'ünïcödé', 'mesh', 'node', 'bone', 'skin', 'morph', 'clip')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,38 @@
 # Copyright © 2021 Mark Summerfield. All rights reserved.
 # License: GPLv3
 
+import array
+import asyncio
 import base64
+import binascii
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import difflib
+import functools
+import gzip
+import hashlib
 import io
+import itertools
+import json
+import lzma
+import math
+import mmap
+import os
 import re
+import shutil
+import struct
 import sys
+import time
+import weakref
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __all__ = ('Oddl',)
 __version__ = '0.1.1'
@@ -13,81 +41,844 @@ __version__ = '0.1.1'
 
 class Oddl:
 
-    def __init__(self, filename=None):
+    parent = None # the Oddl is the root of its tree of structures
+
+    def __init__(self, filename=None, *, lazy=False):
         self.clear()
+        self.filename = filename
         if filename is not None:
-            self.filename = filename
-            self.load()
+            self.load(lazy=lazy)
 
 
     def clear(self):
-        self.global_names = set()
-        self.structures = []
+        self.lazy = False # True if some bodies may not have been parsed
+        self.global_names = {} # $name -> structure
+        self.local_names = {} # %name -> top-level structure
+        self.references = [] # (structure, reference) for every reference
+        self._referrers = None
+        self._index = None
+        self._digest = None
+        self.source = None # the text passed to loads() for edit()
+        self._stale = False # True if an edit() failed to parse
+        self._source_file = None # (filename, size, mtime, byte offsets?)
+        self._structures = Structures(self)
+        self.dirty = False # True if the top-level structures were changed
 
 
-    def load(self, filename=None):
-        filename = filename or self.filename
-        with open(filename, 'rt', encoding='utf-8') as file:
-            self.loads(file.read())
+    @property
+    def structures(self):
+        return self._structures
+
+
+    @structures.setter
+    def structures(self, structures):
+        self._structures.release(list(self._structures))
+        self._structures = Structures(self, structures)
+        self.touch()
+
+
+    @property
+    def children(self):
+        return self._structures
+
+
+    def touch(self):
+        # Called when the top-level structures have changed
+        self.dirty = True
+        self.drop_indexes()
+
+
+    def drop_indexes(self):
+        # Called when the tree has changed (see Structure.touch())
+        self._index = None
+        self._referrers = None
+        self._digest = None
+
+
+    def digest(self):
+        # Returns a hash of the whole tree (see Structure.digest())
+        if self._digest is None:
+            hasher = new_hasher(b'O')
+            for structure in self.structures:
+                hasher.update(structure.digest())
+            self._digest = hasher.digest()
+        return self._digest
+
+
+    def diff(self, other):
+        # Returns the Differences between this (old) tree and the other
+        # (new) one in document order (see diff_structures())
+        return diff_structures(self, other)
+
+
+    def duplicates(self, pattern=None):
+        # Returns groups (lists in document order) of two or more
+        # structures with the same content (see content_digest()) in order
+        # of their first structures. By default every primitive structure
+        # is considered (so equal data payloads are grouped); a select()
+        # pattern may be given to consider others, e.g., '//Material'
+        # groups materials that differ only in their names.
+        if pattern is None:
+            structures = [structure for structure in self.index.structures
+                          if isinstance(structure, PrimitiveStructure)]
+        else:
+            structures = self.select(pattern)
+        groups = {}
+        for structure in structures:
+            groups.setdefault(structure.content_digest(), []).append(
+                structure)
+        return [group for group in groups.values() if len(group) > 1]
 
 
-    def loads(self, text):
+    @property
+    def index(self):
+        # The index used by select(); built on first use after a change
+        if self._index is None:
+            self.realize()
+            self._index = Index(self)
+        return self._index
+
+
+    def select(self, pattern):
+        # Returns the structures that match the pattern in document order,
+        # e.g., 'GeometryObject/Mesh/VertexArray[attrib="position"]'; a
+        # pattern is a '/'-separated path of datatypes (or * for any),
+        # each optionally followed by [property] or [property=value]
+        # predicates, with // instead of / (or at the start) to match
+        # descendants at any depth rather than only children
+        return Query.get(pattern).select(self)
+
+
+    def numpy(self, pattern=None):
+        # Returns the data of the numeric (or bool) primitive structures
+        # that match the select() pattern (default all) as one NumPy array
+        # concatenated in document order, e.g., every vertex position as an
+        # (n, 3) float32 array for '//VertexArray[attrib="position"]/f32';
+        # the structures must have the same data-type and array size
+        arrays = [structure.numpy()
+                  for structure in self.numeric_structures(pattern)]
+        if not arrays:
+            raise Error(f'no numeric data matches {pattern!r}')
+        if len({(array_.dtype, array_.shape[1:]) for array_ in arrays}) > 1:
+            raise Error(f'mixed data-types or array sizes match '
+                        f'{pattern!r}')
+        return arrays[0] if len(arrays) == 1 else numpy.concatenate(arrays)
+
+
+    def export_numpy(self, filename, pattern=None, *, compress=False):
+        # Saves the data of the numeric (or bool) primitive structures that
+        # match the select() pattern (default all): to a .npy file as one
+        # array (see numpy()), otherwise to an .npz file with an array per
+        # structure named by its path (see Structure.path())
+        if filename.endswith('.npy'):
+            numpy_module().save(filename, self.numpy(pattern))
+            return
+        arrays = {}
+        for structure in self.numeric_structures(pattern):
+            name = base = structure.path()
+            i = 1
+            while name in arrays:
+                i += 1
+                name = f'{base}#{i}'
+            arrays[name] = structure.numpy()
+        save = (numpy_module().savez_compressed if compress else
+                numpy_module().savez)
+        save(filename, **arrays)
+
+
+    def numeric_structures(self, pattern=None):
+        structures = (self.index.structures if pattern is None else
+                      self.select(pattern))
+        return [structure for structure in structures
+                if isinstance(structure, PrimitiveStructure) and
+                structure.datatype in DTYPE_FOR_DATATYPE]
+
+
+    def resolve(self, reference, structure=None):
+        # Returns the structure the reference refers to, or None if it is
+        # null or unresolvable; structure is the one whose property or
+        # data holds the reference (needed only for those that start with
+        # a %local name, which are looked up in its scope and then in each
+        # enclosing scope)
+        if reference == 'null':
+            return None
+        first, *rest = REFERENCE_PART_RX.findall(reference)
+        if first.startswith('$'):
+            target = self.global_names.get(first)
+            if target is None and self.lazy:
+                self.realize()
+                target = self.global_names.get(first)
+        else:
+            target = None
+            scope = self if structure is None else structure
+            while target is None and scope is not None:
+                target = scope.lookup(first)
+                scope = scope.parent
+        for name in rest:
+            if target is None:
+                break
+            target = target.lookup(name)
+        return target
+
+
+    def lookup(self, name):
+        return self.local_names.get(name)
+
+
+    def referrers(self, structure):
+        # Returns the (structure, reference) pairs that refer to the given
+        # structure; the reverse index is built on first use
+        if self._referrers is None:
+            self.realize()
+            self._referrers = collections.defaultdict(list)
+            for holder, reference in self.references:
+                target = self.resolve(reference, holder)
+                if target is not None:
+                    self._referrers[target].append((holder, reference))
+        return self._referrers.get(structure, [])
+
+
+    def realize(self):
+        # Parses every body that was skipped by a lazy load
+        if self.lazy:
+            stack = list(self.structures)
+            while stack:
+                structure = stack.pop()
+                if isinstance(structure, DerivedStructure):
+                    stack.extend(structure.children)
+            self.lazy = False
+
+
+    def load(self, filename=None, *, lazy=False, jobs=1, cache=False,
+             mapped=False, stats=None):
+        # If cache is True (or a cache filename) the parsed tree is read
+        # from a side-car binary cache (default filename + 'c') when that
+        # is up to date with the file, and written there otherwise; numeric
+        # data loaded from a cache is a memoryview of the mmap-ed cache.
+        # If mapped, the file is mmap-ed and its bytes parsed in place
+        # rather than being read and decoded into a str. For stats see
+        # loads(). A gzip, bzip2, or xz compressed file (recognized by its
+        # magic bytes) is decompressed in chunks straight into the parser
+        # (and lazy, jobs, and mapped are ignored).
+        self.filename = filename = filename or self.filename
+        compression = compression_for(filename)
+        if mapped and not cache and compression is None:
+            self.load_mapped(filename, lazy=lazy, jobs=jobs, stats=stats)
+            return
+        if not cache:
+            if compression is not None:
+                self.load_compressed(filename, compression, stats=stats)
+                return
+            stat = os.stat(filename)
+            # newline='' so that offsets match the file's (e.g., CRLF) text
+            with open(filename, 'rt', encoding='utf-8', newline='') as file:
+                self.loads(file.read(), lazy=lazy, jobs=jobs, stats=stats)
+            self._source_file = (filename, stat.st_size, stat.st_mtime_ns,
+                                 self.source.isascii())
+            self.source = None
+            return
+        cache = Cache(filename, None if cache is True else cache)
+        if cache.load(self):
+            return
+        stat = os.stat(filename)
+        if compression is not None:
+            self.load_compressed(filename, compression, stats=stats)
+            cache.save(self, stat, cache.digest())
+            return
+        with open(filename, 'rb') as file:
+            data = file.read()
+        self.loads(data.decode('utf-8'), jobs=jobs, stats=stats)
+        self.source = None
+        cache.save(self, stat, hashlib.sha256(data).digest())
+
+
+    def load_compressed(self, filename, compression, *, stats=None):
+        # Only the text of the structures not yet parsed is held in memory,
+        # never the whole decompressed text; since the offsets are in the
+        # decompressed text there is no source file for incremental saves
+        parser = Parser(self) if stats is None else StatsParser(self, stats)
+        try:
+            with compression.open(filename, 'rt',
+                                  encoding='utf-8') as file:
+                for _ in parser.iterparse(file, CHUNK_SIZE):
+                    pass
+        except DECOMPRESSION_ERRORS as err:
+            raise Error(f'ERROR: {filename!r}: invalid compressed data: '
+                        f'{err}') from err
+
+
+    def load_mapped(self, filename, *, lazy=False, jobs=1, stats=None):
+        stat = os.stat(filename)
+        with open(filename, 'rb') as file:
+            try:
+                text = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # an empty file can't be mapped
+                text = b''
+        try:
+            self.loads(text, lazy=lazy, jobs=jobs, stats=stats)
+            self._source_file = (filename, stat.st_size, stat.st_mtime_ns,
+                                 True)
+        finally:
+            self.source = None
+            if not lazy and text: # lazy bodies are parsed from the mmap
+                text.close()
+
+
+    def iterparse(self, filename=None, *, events=None, keep=False,
+                  chunksize=None):
+        # Reads the file in chunks and yields (event, value) pairs for
+        # each top-level structure as soon as it has been read: events are
+        # 'start' and 'end' (structure), 'property' ((name, value)), and
+        # 'data' (primitive structure). Unless keep is True each top-level
+        # structure is dropped once its events have been handled.
+        self.filename = filename = filename or self.filename
+        events = EVENTS if events is None else frozenset(events)
+        parser = Parser(self)
+        with open_file(filename) as file:
+            for structure in parser.iterparse(file,
+                                              chunksize or CHUNK_SIZE):
+                yield from structure.iterevents(events)
+                if not keep:
+                    self.clear()
+
+
+    async def aload(self, filename=None, *, executor=None,
+                    semaphore=None):
+        # Like load() but for asyncio: the file is read in chunks and parsed
+        # in the executor (the loop's default if None; a process pool may
+        # be used to parse files in parallel); at most ASYNC_LIMIT aload()s,
+        # asave()s, and astructures() steps (or the semaphore's limit) use
+        # the executor at once so that big files can't fill it up
+        self.filename = filename = filename or self.filename
+        loop = asyncio.get_running_loop()
+        io_executor = io_executor_for(executor)
+        async with semaphore or async_semaphore():
+            file = await loop.run_in_executor(io_executor, open, filename,
+                                              'rb')
+            try:
+                stat = os.fstat(file.fileno())
+                chunks = []
+                while True:
+                    chunk = await loop.run_in_executor(io_executor,
+                                                       file.read, CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                file.close()
+            text = b''.join(chunks)
+            compression = compression_for_magic(text)
+            flat = await loop.run_in_executor(executor, parse_text, filename,
+                                              text, compression)
         parser = Parser(self)
-        parser.parse(text)
+        parser.clear()
+        parser.merge(unflatten(flat))
+        if compression is None:
+            self._source_file = (filename, stat.st_size, stat.st_mtime_ns,
+                                 True)
 
 
-    def save(self, filename=None):
+    async def asave(self, filename=None, *, executor=None, semaphore=None):
+        # Like save() but for asyncio: the tree is serialized and written in
+        # chunks in the executor (the loop's default if None or if it is a
+        # process pool); see aload() for the semaphore
+        filename = filename or self.filename
+        loop = asyncio.get_running_loop()
+        async with semaphore or async_semaphore():
+            await loop.run_in_executor(io_executor_for(executor), self.save,
+                                       filename)
+
+
+    async def astructures(self, filename=None, *, keep=False,
+                          chunksize=None, executor=None, semaphore=None):
+        # An async iterator of the file's top-level structures which are
+        # read and parsed one at a time in the executor (see asave()); see
+        # iterparse() for keep and chunksize
+        self.filename = filename = filename or self.filename
+        loop = asyncio.get_running_loop()
+        executor = io_executor_for(executor)
+        semaphore = semaphore or async_semaphore()
+        parser = Parser(self)
+        async with semaphore:
+            file = await loop.run_in_executor(executor, open_file,
+                                              filename)
+        try:
+            structures = parser.iterparse(file, chunksize or CHUNK_SIZE)
+            while True:
+                async with semaphore:
+                    structure = await loop.run_in_executor(
+                        executor, next, structures, None)
+                if structure is None:
+                    break
+                yield structure
+                if not keep:
+                    self.clear()
+        finally:
+            file.close()
+
+
+    def loads(self, text, *, lazy=False, jobs=1, stats=None):
+        # The text may be a str or UTF-8 bytes (or an mmap of them).
+        # If lazy, each derived structure's body is skipped and only parsed
+        # when its structures (or local names) are first accessed.
+        # Otherwise, if jobs isn't 1, the top-level structures are parsed
+        # by a pool of that many processes (0 means one per CPU).
+        # If stats is a Stats, the whole text (even if lazy) is parsed in
+        # this process by an instrumented parser that adds to the stats and
+        # calls its hooks; otherwise the (uninstrumented) parser is used.
+        if stats is None:
+            parser = Parser(self, lazy=lazy)
+        else:
+            parser = StatsParser(self, stats)
+            jobs = 1
+            lazy = False
+        if jobs != 1 and not lazy:
+            parser.parse_parallel(text, jobs or os.cpu_count() or 1)
+        else:
+            parser.parse(text)
+        self.lazy = lazy
+        self.source = text
+
+
+    def edit(self, offset, removed, inserted):
+        # Applies an edit (e.g., from an editor) to the text passed to
+        # loads(): removes the given number of characters at the offset and
+        # inserts the given text there. Only the innermost structure that
+        # encloses the edit is reparsed if its text still parses as exactly
+        # one structure, otherwise its parent is tried, and so on, and if
+        # need be the whole text is reparsed. Returns the new structure
+        # (or None if the whole text was reparsed). Raises Error if the
+        # edited text is invalid, after which the next edit() reparses the
+        # whole text. Assumes the tree has only been changed by edit().
+        source = self.source
+        if source is None:
+            raise Error('edit() needs the text passed to loads()')
+        self.realize()
+        text = source[:offset] + inserted + source[offset + removed:]
+        delta = len(inserted) - removed
+        structure = (None if self._stale else
+                     self.enclosing(offset, offset + removed))
+        while structure is not None:
+            new = self.reparse(structure, text, delta)
+            if new is not None:
+                self.source = text
+                return new
+            parent = structure.parent
+            structure = parent if isinstance(parent, Structure) else None
+        try:
+            self.loads(text)
+        except Error:
+            self.source = text
+            self._stale = True
+            raise
+
+
+    def enclosing(self, start, end):
+        # Returns the innermost structure whose source text strictly
+        # encloses the span, or None
+        structure = None
+        children = self.structures
+        base = 0
+        while children:
+            low = 0
+            high = len(children)
+            while low < high: # find the last child that starts before
+                middle = (low + high) // 2
+                offset = children[middle].offset
+                if offset is None:
+                    return None
+                if base + offset < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            if not low:
+                break
+            child = children[low - 1]
+            child_start = base + child.offset
+            if end >= child_start + child.size:
+                break
+            structure = child
+            base = child_start
+            children = (child.children if isinstance(child, DerivedStructure)
+                        else ())
+        return structure
+
+
+    def reparse(self, structure, text, delta):
+        # Parses the structure's edited text and, if it is still exactly one
+        # structure, replaces the structure with it and returns it; returns
+        # None if it isn't
+        parent = structure.parent
+        start, end = structure.source_span()
+        old = [structure]
+        for item in old: # appends to old while iterating
+            if isinstance(item, DerivedStructure):
+                old.extend(item.children)
+        scratch = Oddl()
+        scratch.filename = self.filename
+        parser = Parser(scratch)
+        lexer = parser.lexer = parser.new_lexer(text)
+        lexer.pos = start
+        parser.starts = [start - structure.offset]
+        try:
+            parser.parse_structure()
+        except Error:
+            return None
+        if lexer.pos != end + delta:
+            return None
+        new = scratch.structures[0]
+        old_names = {item.name for item in old
+                     if item.name is not None and item.name[0] == '$'}
+        for name in scratch.global_names:
+            if name in self.global_names and name not in old_names:
+                return None # let a full reparse report the duplicate
+        names = parent.local_names
+        if (new.name is not None and new.name[0] == '%' and
+                names.get(new.name, structure) is not structure):
+            return None
+        # The new structure is valid so replace the old one with it
+        for name in old_names:
+            del self.global_names[name]
+        self.global_names.update(scratch.global_names)
+        if structure.name is not None and structure.name[0] == '%':
+            del names[structure.name]
+        if new.name is not None and new.name[0] == '%':
+            names[new.name] = new
+        old = set(old)
+        self.references = [item for item in self.references
+                           if item[0] not in old]
+        self.references += scratch.references
+        structures = parent.structures
+        i = structures.index(structure)
+        new.parent = parent
+        list.__setitem__(structures, i, new)
+        # Move the following structures and enlarge the enclosing ones
+        while True:
+            for sibling in structures[i + 1:]:
+                sibling.offset += delta
+            if not isinstance(parent, Structure):
+                break
+            parent.size += delta
+            parent._digest = None
+            structure = parent
+            parent = structure.parent
+            structures = parent.structures
+            i = structures.index(structure)
+        self.drop_indexes()
+        return new
+
+
+    def save(self, filename=None, *, incremental=False):
+        # The output is written to the file in chunks as it is produced.
+        # If incremental and the source is available (the text passed to
+        # loads() or the loaded file if it hasn't changed since), unchanged
+        # structures are copied from it verbatim (keeping their comments
+        # and formatting) and only the dirty ones are reserialized; the
+        # file is then written via a temporary file (since it may be the
+        # source). If the filename ends with .gz, .bz2, or .xz the output
+        # is compressed as it is written (and is never incremental).
         filename = filename or self.filename
-        with open(filename, 'wt', encoding='utf-8') as file:
+        self.realize() # a lazy body may be in the file being overwritten
+        if incremental and compression_for(filename, 'w') is None:
+            temp = f'{filename}.{os.getpid()}.tmp'
+            try:
+                written = self.save_incremental(temp)
+                if written is not None:
+                    with contextlib.suppress(OSError): # keep its mode
+                        shutil.copymode(filename, temp)
+                    os.replace(temp, filename)
+                    if not written and self.source is None:
+                        # An exact copy so the spans are valid for it too
+                        stat = os.stat(filename)
+                        self._source_file = (filename, stat.st_size,
+                                             stat.st_mtime_ns,
+                                             self._source_file[3])
+                    return
+            finally:
+                with contextlib.suppress(OSError):
+                    os.remove(temp)
+        with open_file(filename, 'wt') as file:
             self.write(file)
 
 
+    def save_incremental(self, filename):
+        # Returns how many structures were reserialized, or None if there's
+        # no source to copy from
+        source = self.source
+        source_file = self._source_file
+        written = 0
+        if source is None:
+            if source_file is None:
+                return None
+            name, size, mtime, byte_offsets = source_file
+            try:
+                stat = os.stat(name)
+            except OSError:
+                return None
+            if stat.st_size != size or stat.st_mtime_ns != mtime:
+                return None
+            if not byte_offsets: # character offsets so must decode
+                with open(name, 'rt', encoding='utf-8',
+                          newline='') as file:
+                    source = file.read()
+        with open(filename, 'wb') as out:
+            if source is not None:
+                for piece in self.pieces(len(source)):
+                    if isinstance(piece, str):
+                        out.write(piece.encode('utf-8'))
+                        written += 1
+                    else:
+                        data = source[piece[0]:piece[1]]
+                        out.write(data.encode('utf-8')
+                                  if isinstance(data, str) else data)
+            else:
+                with open(name, 'rb') as file:
+                    for piece in self.pieces(size):
+                        if isinstance(piece, str):
+                            out.write(piece.encode('utf-8'))
+                            written += 1
+                        else:
+                            copy_range(file, out, *piece)
+        return written
+
+
+    def pieces(self, size):
+        # Yields (start, end) spans of the source text of size characters
+        # (or bytes) to copy and strs to write that together are the text
+        # of the tree
+        structures = self.structures
+        if self.dirty or any(structure.offset is None
+                             for structure in structures):
+            for structure in structures: # lost the text between them
+                yield from structure.pieces(0, 0)
+                yield '\n'
+            return
+        pos = 0
+        for structure in structures:
+            start = structure.offset
+            yield pos, start
+            yield from structure.pieces(0, 0)
+            pos = start + structure.size
+        yield pos, size
+
+
     dump = save
 
 
     def dumps(self):
-        out = io.StringIO()
-        try:
-            self.write(out)
-            return out.getvalue()
-        finally:
-            out.close()
+        writer = Writer()
+        self.write(writer)
+        return writer.getvalue()
 
 
     def write(self, out):
+        writer = out if isinstance(out, Writer) else Writer(out)
         for structure in self.structures:
-            structure.write(out, '')
+            structure.write(writer)
+        writer.flush()
 
 
     def check(self):
-        pass  # TODO
+        # Returns a list of the problems found (empty if there are none):
+        # invalid or duplicate names, unresolvable references, properties
+        # and data that don't match their types, and data array lists
+        # whose sizes or states don't match their declarations; the tree
+        # is checked in one walk, references once it has been walked
+        # against the names the walk found (not the name tables, which
+        # changes made bypassing them wouldn't have updated)
+        self.realize()
+        file = f' {self.filename!r}' if self.filename else ''
+        problems = []
+        references = []
+        global_names = {}
+        scopes = {self: {}} # parent -> the %names of its children
+        stack = [(structure, scopes[self])
+                 for structure in reversed(self.structures)]
+        while stack:
+            structure, scope = stack.pop()
+            messages = []
+            name = structure.name
+            if name is not None:
+                names = global_names if name.startswith('$') else scope
+                if not isinstance(name, str) or not NAME_RX.fullmatch(name):
+                    messages.append(f'invalid name {name!r}')
+                elif name in names:
+                    messages.append(f'duplicate name {name}')
+                else:
+                    names[name] = structure
+            if isinstance(structure, PrimitiveStructure):
+                messages += structure.problems()
+                if structure.datatype == 'r' and structure.data:
+                    references += ((structure, value)
+                                   for value in structure.data)
+            else:
+                datatype = structure.datatype
+                if (not isinstance(datatype, str) or
+                        not ID_RX.fullmatch(datatype) or
+                        RESERVED_STRUCTURE_ID_RX.fullmatch(datatype)):
+                    messages.append(f'invalid structure identifier '
+                                    f'{datatype!r}')
+                if structure.has_properties:
+                    for key, value in structure.properties.items():
+                        if (not isinstance(key, str) or
+                                not ID_RX.fullmatch(key)):
+                            messages.append(f'invalid property {key!r}')
+                        elif not isinstance(value, PROPERTY_TYPES):
+                            messages.append(f'invalid property {key} '
+                                            f'value {value!r}')
+                        elif isinstance(value, Reference):
+                            references.append((structure, value))
+                scope = scopes[structure] = {}
+                stack.extend((child, scope)
+                             for child in reversed(structure.children))
+            for message in messages:
+                problems.append(f'ERROR:{file} {structure.path()}: '
+                                f'{message!r}')
+        for structure, reference in references:
+            if (not isinstance(reference, str) or
+                    not Reference.REGEX.fullmatch(reference) or
+                    reference == 'null'):
+                continue
+            first, *rest = REFERENCE_PART_RX.findall(reference)
+            if first.startswith('$'):
+                target = global_names.get(first)
+            else: # in the holder's scope and then each enclosing one
+                target = None
+                scope = structure
+                while target is None and scope is not None:
+                    target = scopes.get(scope, {}).get(first)
+                    scope = scope.parent
+            for name in rest:
+                if target is None:
+                    break
+                target = scopes.get(target, {}).get(name)
+            if target is None:
+                problems.append(f'ERROR:{file} {structure.path()}: '
+                                f'{f"unresolved reference {reference}"!r}')
+        return problems
 
 
     lint = check
 
 
-class Base64Data(bytes):
+class Base64Data:
 
-    __slots__ = ()
+    # Holds the base-64 text as parsed and only decodes it (in bulk) when
+    # the data is first accessed; if never decoded it is written as is
+
+    __slots__ = ('text', '_data')
 
     REGEX = re.compile(
-        r'[A-Za-z0-9][A-Za-z0-9][+/\s\nA-Za-z0-9]*={0,2}',
-        re.DOTALL | re.MULTILINE)
+        r'[+/0-9A-Za-z](?:[ \t\n\r\f\v+/0-9A-Za-z]*[+/0-9A-Za-z])?'
+        r'(?:[ \t\n\r\f\v]*=){0,2}')
+    ALPHABET = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                '0123456789+/')
+    STRIP_TABLE = str.maketrans('', '', ' \t\n\r\f\v=')
+
+    def __init__(self, value):
+        if self.REGEX.fullmatch(value) is None:
+            raise Error(f'invalid base-64-data: {value!r}')
+        self.text = value
+        self._data = None
+        self.check()
+
+
+    @classmethod
+    def fromtext(Class, text):
+        # text must already match REGEX (e.g., the parser's token)
+        value = Class.__new__(Class)
+        value.text = text
+        value._data = None
+        value.check()
+        return value
+
+
+    @classmethod
+    def frombytes(Class, data):
+        value = Class.__new__(Class)
+        value.text = None
+        value._data = bytes(data)
+        return value
 
-    def __new__(Class, value):
-        message = ''
-        match = Class.REGEX.fullmatch(value)
-        if match is not None:
+
+    def check(self):
+        # Cheap equivalent of a2b_base64()'s padding check so that invalid
+        # data is reported when parsed, not when first accessed
+        text = self.text
+        pads = text.count('=')
+        count = len(text) - pads - sum(map(text.count, ' \t\n\r\f\v'))
+        if not (count % 4 == 0 or (count % 4 == 2 and pads == 2) or
+                (count % 4 == 3 and pads)):
+            raise Error(f'invalid base-64-data Incorrect padding: '
+                        f'{text[:40]!r}')
+
+
+    @property
+    def data(self):
+        if self._data is None:
             try:
-                return super().__new__(Class, base64.b64decode(
-                                       match[0].encode('utf-8')))
-            except base64.Error as err:
-                message = f' {err}'
-        raise Error(f'invalid base-64-data{message}: {value!r}')
+                self._data = binascii.a2b_base64(self.text)
+            except binascii.Error as err:
+                raise Error(f'invalid base-64-data {err}: '
+                            f'{self.text[:40]!r}') from err
+        return self._data
+
+
+    @property
+    def decoded(self):
+        return self._data is not None
+
+
+    def __bytes__(self):
+        return self.data
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def __eq__(self, other):
+        if isinstance(other, Base64Data):
+            if self.text is not None and self.text == other.text:
+                return True
+            other = other.data
+        elif not isinstance(other, (bytes, bytearray, memoryview)):
+            return NotImplemented
+        return self.data == other
+
+
+    def __hash__(self):
+        # Hashes the encoding without its whitespace and padding (and any
+        # unused bits in its last digit) so that indexing property values
+        # doesn't decode them; unlike __eq__() this doesn't match bytes
+        text = self.encoded().translate(self.STRIP_TABLE)
+        extra = len(text) % 4
+        if extra:
+            digit = self.ALPHABET.index(text[-1]) & (0x30 if extra == 2
+                                                     else 0x3C)
+            text = text[:-1] + self.ALPHABET[digit]
+        return hash((Base64Data, text))
+
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.encoded()!r})'
+
+
+    def __reduce__(self):
+        # Undecoded values keep their text so that they are written as is
+        if self._data is None:
+            return self.__class__.fromtext, (self.text,)
+        return self.__class__.frombytes, (self.data,)
+
+
+    def encoded(self):
+        if self._data is None:
+            return self.text
+        return base64.b64encode(self._data).decode('ascii')
 
 
     def write(self, out):
-        out.write(base64.b64encode(self).decode('ascii'))
+        out.write(self.encoded())
 
 
 class DataType(str):
@@ -95,18 +886,22 @@ class DataType(str):
     __slots__ = ()
 
     REGEX = re.compile( # NOTE Must be ordered longest to shortest
-        r'(:?float16|float32|float64|base64|uint16|uint32|uint64|string|'
+        r'(?:float16|float32|float64|base64|uint16|uint32|uint64|string|'
         r'double|float|int16|int32|int64|uint8|int8|bool|half|type|f16|'
-        r'u32|u64|f32|f64|i16|i32|i64|u16|ref|i8|u8|b|d|f|h|r|s|t|z)')
+        r'u32|u64|f32|f64|i16|i32|i64|u16|ref|i8|u8|b|d|f|h|r|s|t|z)'
+        r'(?![0-9A-Za-z_])')
 
     NAME_FOR_NAME = { # prefer shortest, but for float prefer most sensible
         'base64': 'z',
         'bool': 'b',
+        'd': 'f64',
         'double': 'f64',
+        'f': 'f32',
         'float': 'f32',
         'float16': 'f16',
         'float32': 'f32',
         'float64': 'f64',
+        'h': 'f16',
         'half': 'f16',
         'int16': 'i16',
         'int32': 'i32',
@@ -120,10 +915,22 @@ class DataType(str):
         'uint64': 'u64',
         'uint8': 'u8'}
 
+    INSTANCE_FOR_NAME = {} # so that each data-type is only held once
+
     def __new__(Class, value):
+        datatype = Class.INSTANCE_FOR_NAME.get(value)
+        if datatype is not None:
+            return datatype
         match = Class.REGEX.fullmatch(value)
         if match is not None:
-            return super().__new__(Class, Class.NAME_FOR_NAME[match[0]])
+            name = match[0]
+            name = Class.NAME_FOR_NAME.get(name, name)
+            datatype = Class.INSTANCE_FOR_NAME.get(name)
+            if datatype is None:
+                datatype = super().__new__(Class, sys.intern(name))
+                Class.INSTANCE_FOR_NAME[name] = datatype
+            Class.INSTANCE_FOR_NAME[value] = datatype
+            return datatype
         raise Error(f'invalid data-type: {value!r}')
 
 
@@ -136,7 +943,8 @@ class Reference(str):
     __slots__ = ()
 
     REGEX = re.compile(
-        r'null|[%$][A-Za-z_][0-9A-Za-z_]*(?:%[A-Za-z_][0-9A-Za-z_]*)*')
+        r'(?:null|[%$][A-Za-z_][0-9A-Za-z_]*(?:%[A-Za-z_][0-9A-Za-z_]*)*)'
+        r'(?![0-9A-Za-z_])')
 
     def __new__(Class, value):
         match = Class.REGEX.fullmatch(value)
@@ -167,7 +975,7 @@ class Real(float):
     __slots__ = ()
 
     def write(self, out):
-        out.write(f'{self:g}')
+        out.write(format_float(self, 'f64'))
 
 
 class String(str):
@@ -184,57 +992,693 @@ class String(str):
 
 class Structure:
 
+    __slots__ = ('_datatype', '_name', 'parent', 'offset', 'size', 'dirty',
+                 '_digest')
+
     def __init__(self, datatype):
-        self.datatype = datatype # built-in or user-defined identifier
-        self.name = None
+        self._datatype = datatype # built-in or user-defined identifier
+        self._name = None
+        self.parent = None # DerivedStructure or Oddl
+        self.offset = None # in the source text relative to the parent's
+        self.size = None # in the source text (None if not parsed)
+        self.dirty = 0 # or DIRTY_WITHIN (a descendant changed) or DIRTY
+        self._digest = None # see digest()
+
+
+    @property
+    def datatype(self):
+        return self._datatype
 
 
-    def write(self, _out, _indent):
+    @datatype.setter
+    def datatype(self, datatype):
+        self._datatype = datatype
+        self.touch()
+
+
+    @property
+    def name(self):
+        return self._name
+
+
+    @name.setter
+    def name(self, name):
+        # Moves the structure to the name table its new name belongs in
+        parent = self.parent
+        if parent is not None:
+            names = None if name is None else name_table(parent, name)
+            if names is not None and names.get(name, self) is not self:
+                raise Error(f'duplicate name {name}')
+            if self._name is not None:
+                old = name_table(parent, self._name)
+                if old is not None and old.get(self._name) is self:
+                    del old[self._name]
+            if names is not None:
+                names[name] = self
+        self._name = name
+        self.touch()
+
+
+    def source_span(self):
+        # Returns the structure's (start, end) offsets in the source text,
+        # or None if it wasn't parsed from it
+        if self.offset is None:
+            return None
+        start = 0
+        structure = self
+        while isinstance(structure, Structure):
+            if structure.offset is None:
+                return None
+            start += structure.offset
+            structure = structure.parent
+        return start, start + self.size
+
+
+    def iterevents(self, events=None):
+        if events is None:
+            events = EVENTS
+        stack = [(self, False)]
+        while stack:
+            structure, done = stack.pop()
+            if done:
+                if 'end' in events:
+                    yield 'end', structure
+                continue
+            if 'start' in events:
+                yield 'start', structure
+            stack.append((structure, True))
+            if isinstance(structure, PrimitiveStructure):
+                if 'data' in events:
+                    yield 'data', structure
+            else:
+                if 'property' in events and structure.has_properties:
+                    for item in structure.properties.items():
+                        yield 'property', item
+                stack.extend((child, False)
+                             for child in reversed(structure.children))
+
+
+    def lookup(self, _name):
+        return None # only derived structures have local names
+
+
+    def path(self):
+        # Returns where the structure is in its tree for messages, e.g.,
+        # 'GeometryNode $node1/Transform/f32'
+        parts = []
+        structure = self
+        while isinstance(structure, Structure):
+            parts.append(str(structure.datatype) if structure.name is None
+                         else f'{structure.datatype} {structure.name}')
+            structure = structure.parent
+        return '/'.join(reversed(parts))
+
+
+    def touch(self):
+        # Must be called after changing a structure in place other than by
+        # setting its attributes or changing its structures or properties
+        # (which call it), e.g., after changing its data in place; marks
+        # it dirty (for incremental saves) and its ancestors
+        # as having a dirty descendant, drops its and their digests, and
+        # drops the indexes over its tree
+        self.dirty = DIRTY
+        self._digest = None
+        parent = self.parent
+        while isinstance(parent, Structure):
+            if not parent.dirty:
+                parent.dirty = DIRTY_WITHIN
+            parent._digest = None
+            parent = parent.parent
+        if parent is not None:
+            parent.drop_indexes()
+
+
+    def digest(self):
+        # Returns a hash of the structure's data-type, name, properties or
+        # data, and descendants (a Merkle hash so equal digests mean equal
+        # subtrees); computed bottom-up using a stack and cached until it
+        # or a descendant is changed (see touch())
+        if self._digest is None:
+            stack = [self]
+            while stack:
+                structure = stack[-1]
+                if (structure._digest is None and
+                        isinstance(structure, DerivedStructure)):
+                    pending = [child for child in structure.children
+                               if child._digest is None]
+                    if pending:
+                        stack += pending
+                        continue
+                stack.pop()
+                if structure._digest is None:
+                    hasher = new_hasher(b'S')
+                    hash_text(hasher, structure.name or '')
+                    hasher.update(structure.content_digest())
+                    structure._digest = hasher.digest()
+        return self._digest
+
+
+    def content_digest(self):
+        # Returns a hash like digest() but ignoring the structure's name
+        raise NotImplementedError
+
+
+    def pieces(self, base, depth):
+        # Yields the (start, end) source spans and strs of the structure's
+        # text (see Oddl.pieces()) given its parent's start and its depth;
+        # the stack holds (structure, base, depth) to visit, (None, start,
+        # end) spans between children, and (str, None, None) text to write
+        stack = [(self, base, depth)]
+        while stack:
+            structure, base, depth = stack.pop()
+            if structure is None:
+                yield base, depth # the span's start and end
+                continue
+            if isinstance(structure, str):
+                yield structure
+                continue
+            if structure.offset is None or (
+                    structure.dirty == DIRTY and
+                    isinstance(structure, PrimitiveStructure)):
+                writer = Writer()
+                structure.write_structure(writer, depth)
+                yield writer.getvalue()[len(writer.indent(depth)):-1]
+                continue
+            start = base + structure.offset
+            end = start + structure.size
+            if not structure.dirty:
+                yield start, end
+                continue
+            stack.extend(reversed(structure.body_items(start, end, depth)))
+
+
+    def select(self, pattern):
+        # Like Oddl.select() but matches only this structure's descendants
+        return Query.get(pattern).select(self)
+
+
+    def write(self, out, depth=0):
+        # out may be a Writer or any object with a write() method
+        if isinstance(out, Writer):
+            self.write_structure(out, depth)
+        else:
+            writer = Writer(out)
+            self.write_structure(writer, depth)
+            writer.flush()
+
+
+    def write_structure(self, _writer, _depth):
         raise NotImplementedError
 
 
 class PrimitiveStructure(Structure):
 
+    __slots__ = ('_data', '_dataarraylistsize', '_dataarrayliststates',
+                 '_states', '_payload')
+
     def __init__(self, datatype):
         super().__init__(datatype)
-        self.datalist = None
-        self.dataarraylistsize = None # None means unlimited else >0
-        self.dataarrayliststates = False
-        self.dataarraylist = None # list of (state, {arraylist}) pairs
-                                  # -or- list of {arraylist}s
+        self._data = None # flat array.array (or memoryview if loaded from
+                          # a cache) for numeric datatypes else list
+        self._dataarraylistsize = None # None means unlimited else >0
+        self._dataarrayliststates = False
+        self._states = None # state identifier (or None) for each array
+        self._payload = None # see content_digest()
+
+
+    @property
+    def data(self):
+        return self._data
+
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.touch()
+
+
+    @property
+    def dataarraylistsize(self):
+        return self._dataarraylistsize
+
+
+    @dataarraylistsize.setter
+    def dataarraylistsize(self, size):
+        self._dataarraylistsize = size
+        self.touch()
+
+
+    @property
+    def dataarrayliststates(self):
+        return self._dataarrayliststates
+
+
+    @dataarrayliststates.setter
+    def dataarrayliststates(self, states):
+        self._dataarrayliststates = states
+        self.touch()
 
 
-    def write(self, out, indent):
-        out.write(f'{indent}{self.datatype}')
+    @property
+    def states(self):
+        return self._states
+
+
+    @states.setter
+    def states(self, states):
+        self._states = states
+        self.touch()
+
+
+    @property
+    def typecode(self):
+        return TYPECODE_FOR_DATATYPE.get(self.datatype)
+
+
+    def touch(self):
+        self._payload = None
+        super().touch()
+
+
+    def content_digest(self):
+        # The hash of the data-type, array size, states, and data, cached
+        # (see touch()); numeric data is hashed in bulk as little-endian
+        if self._payload is None:
+            hasher = new_hasher(b'P')
+            hash_text(hasher, self.datatype)
+            hash_int(hasher, self.dataarraylistsize or 0)
+            if self.dataarrayliststates:
+                states = self.states or ()
+                hash_int(hasher, len(states))
+                for state in states:
+                    hash_text(hasher, state or '')
+            data = () if self.data is None else self.data
+            hash_int(hasher, len(data))
+            typecode = self.typecode
+            if typecode is not None:
+                if not (isinstance(data, array.array) and
+                        data.typecode == typecode or
+                        isinstance(data, memoryview) and
+                        data.format == typecode):
+                    data = array.array(typecode, data)
+                if sys.byteorder == 'big':
+                    data = array.array(typecode, data)
+                    data.byteswap()
+                hasher.update(data)
+            else:
+                for value in data:
+                    hash_value(hasher, value)
+            self._payload = hasher.digest()
+        return self._payload
+
+
+    def numpy(self):
+        # Returns the data as a NumPy array of shape (arrays,
+        # dataarraylistsize) for data array lists, else (values,), with
+        # the data-type's dtype; it shares the data's buffer (so no copy is
+        # made and changes to either show in both) when the data is an
+        # array.array or memoryview, except for f16 which is held as
+        # float32 and must be converted
+        numpy = numpy_module()
+        dtype = DTYPE_FOR_DATATYPE.get(self.datatype)
+        if dtype is None:
+            raise Error(f'{self.datatype} data has no NumPy dtype')
+        data = () if self.data is None else self.data
+        typecode = self.typecode
+        if typecode is not None and (
+                isinstance(data, array.array) and data.typecode == typecode or
+                isinstance(data, memoryview) and data.format == typecode):
+            values = numpy.frombuffer(data, dtype=typecode)
+            if values.dtype != dtype:
+                values = values.astype(dtype)
+        else:
+            values = numpy.array(data, dtype=dtype)
+        size = self.dataarraylistsize
+        return values if size is None else values.reshape(-1, size)
+
+
+    def make_data(self, values):
+        typecode = self.typecode
+        if typecode is None:
+            return list(values)
+        if (isinstance(values, array.array) and
+                values.typecode == typecode or
+                isinstance(values, memoryview) and
+                values.format == typecode):
+            return values
+        try:
+            return array.array(typecode, values)
+        except (OverflowError, TypeError) as err:
+            raise Error(f'invalid {self.datatype} data: {err}') from err
+
+
+    @property
+    def datalist(self):
+        if self.dataarraylistsize is None:
+            return self.data
+
+
+    @datalist.setter
+    def datalist(self, values):
+        self._dataarraylistsize = None
+        self._dataarrayliststates = False
+        self._states = None
+        self._data = None if values is None else self.make_data(values)
+        self.touch()
+
+
+    @property
+    def dataarraylist(self):
+        # A list of (state, {arraylist}) pairs -or- a list of {arraylist}s
+        size = self.dataarraylistsize
+        if size is None or self.data is None:
+            return None
+        data = self.data
+        arraylist = [data[i:i + size] for i in range(0, len(data), size)]
+        if self.dataarrayliststates:
+            return list(zip(self.states, arraylist))
+        return arraylist
+
+
+    @dataarraylist.setter
+    def dataarraylist(self, arraylist):
+        # dataarraylistsize and dataarrayliststates must already be set
+        if arraylist is None:
+            self._data = self._states = None
+            self.touch()
+            return
+        if self.dataarrayliststates:
+            states = [state for state, _ in arraylist]
+            arraylist = [values for _, values in arraylist]
+        values = []
+        for array_ in arraylist:
+            if len(array_) != self.dataarraylistsize:
+                raise Error(f'expected {self.dataarraylistsize} data array '
+                            f'elements, got {len(array_)}')
+            values.extend(array_)
+        self._data = self.make_data(values)
+        if self.dataarrayliststates:
+            self._states = states
+        self.touch()
+
+
+    @property
+    def view(self):
+        # A zero-copy memoryview of numeric data shaped (arrays,
+        # dataarraylistsize) for data array lists (memoryview can't have a
+        # zero dimension, so an empty view is always one-dimensional)
+        if self.typecode is None or self.data is None:
+            return None
+        view = memoryview(self.data)
+        size = self.dataarraylistsize
+        if size is not None and self.data:
+            view = view.cast('B').cast(self.typecode,
+                                       (len(self.data) // size, size))
+        return view
+
+
+    def problems(self):
+        # Returns a list of the ways the structure's data doesn't match
+        # its data-type and data array list declaration (see Oddl.check())
+        datatype = self.datatype
+        if (not isinstance(datatype, str) or
+                not DataType.REGEX.fullmatch(datatype)):
+            return [f'invalid data-type {datatype!r}']
+        datatype = DataType(datatype)
+        problems = []
+        data = () if self.data is None else self.data
+        size = self.dataarraylistsize
+        count = None # of arrays
+        if size is not None:
+            if not isinstance(size, int) or size < 1:
+                problems.append(f'invalid data array size {size!r}')
+            elif len(data) % size:
+                problems.append(f'{len(data)} data array elements is not a '
+                                f'multiple of the array size {size}')
+            else:
+                count = len(data) // size
+        states = self.states
+        if self.dataarrayliststates:
+            if size is None:
+                problems.append('state markers without a data array size')
+            elif states is None or (count is not None and
+                                    len(states) != count):
+                got = 0 if states is None else len(states)
+                problems.append(f'expected {count} state markers, got '
+                                f'{got}')
+            else:
+                for state in states:
+                    if state is not None and (not isinstance(state, str) or
+                                              not ID_RX.fullmatch(state)):
+                        problems.append(f'invalid state marker {state!r}')
+                        break
+        elif states is not None:
+            problems.append('state markers without states (*) declared')
+        typecode = TYPECODE_FOR_DATATYPE.get(datatype)
+        if typecode is not None and (
+                isinstance(data, array.array) and data.typecode == typecode or
+                isinstance(data, memoryview) and data.format == typecode):
+            # The array's type guarantees the values' type and range
+            # except for f16 which is held in float32s
+            if datatype == 'f16' and data and not (
+                    -F16_MAX <= min(data) and max(data) <= F16_MAX):
+                values = [value for value in data
+                          if abs(value) > F16_MAX and not math.isinf(value)]
+                if values:
+                    problems.append(f'value {values[0]!r} out of range for '
+                                    f'f16')
+            return problems
+        valid = VALID_FOR_DATATYPE[datatype]
+        for value in data:
+            if not valid(value, datatype):
+                problems.append(f'value {value!r} is not valid {datatype} '
+                                f'data')
+                break
+        return problems
+
+
+    def texts(self):
+        # Returns the data formatted as a list of strings, one per value,
+        # formatting numeric data in bulk
+        data = self.data
+        if not data:
+            return []
+        datatype = self.datatype
+        if datatype in FLOAT_TYPES:
+            return format_floats(data, datatype)
+        if datatype in INT_TYPES:
+            return list(map(str, data))
+        if datatype == 's':
+            table = String.TRANS_TABLE
+            return [f'"{value.translate(table)}"' for value in data]
+        if datatype == 'b':
+            return ['true' if value else 'false' for value in data]
+        if datatype == 'z':
+            return [value.encoded() for value in data]
+        return list(data) # r and t
+
+
+    def write_structure(self, writer, depth):
+        indent = writer.indent(depth)
+        size = self.dataarraylistsize
+        header = [indent, self.datatype]
+        if size is not None:
+            header.append(f'[{size}]*' if self.dataarrayliststates
+                          else f'[{size}]')
         if self.name is not None:
-            out.write(f' {self.name}')
-        out.write('\n')
-        # TODO
+            header += (' ', self.name)
+        texts = self.texts()
+        if size is not None:
+            items = ['{' + ', '.join(texts[i:i + size]) + '}'
+                     for i in range(0, len(texts), size)]
+            if self.dataarrayliststates:
+                items = [item if state is None else f'{state} {item}'
+                         for state, item in zip(self.states, items)]
+        else:
+            items = texts
+        if len(items) <= 1 or sum(map(len, items)) < LINE_WIDTH // 2:
+            writer.write(''.join(header) + ' {' + ', '.join(items) + '}\n')
+            return
+        inner = writer.indent(depth + 1)
+        width = max(map(len, items)) + 2
+        count = max(1, (LINE_WIDTH - len(inner)) // width)
+        writer.write(''.join(header) + f'\n{indent}{{\n')
+        separator = f',\n{inner}'
+        writer.write(inner + separator.join(
+            ', '.join(items[i:i + count])
+            for i in range(0, len(items), count)))
+        writer.write(f'\n{indent}}}\n')
 
 
 class DerivedStructure(Structure):
 
+    __slots__ = ('_structures', '_properties', '_local_names', 'body',
+                 '_body_start')
+
     def __init__(self, datatype):
+        # Most structures have no properties or local names and some have
+        # no structures, so each container is only created when first used
         super().__init__(datatype)
-        self.structures = []
-        self.properties = {}
+        self._structures = None
+        self._properties = None
+        self._local_names = None # %name -> child structure
+        self.body = None # (oddl, text, pos) of a body yet to be parsed
+        # The offset just past the body's "{" relative to the structure's
+        # (None if not parsed or a child has been removed since)
+        self._body_start = None
+
+
+    def content_digest(self):
+        # The hash of the data-type, properties, and children's digests
+        hasher = new_hasher(b'D')
+        hash_text(hasher, self.datatype)
+        properties = self._properties or {}
+        hash_int(hasher, len(properties))
+        for name in sorted(properties):
+            hash_text(hasher, name)
+            hash_value(hasher, properties[name])
+        children = self.children
+        hash_int(hasher, len(children))
+        for child in children:
+            hasher.update(child.digest())
+        return hasher.digest()
+
+
+    @property
+    def structures(self):
+        if self.body is not None:
+            self.parse_body()
+        if self._structures is None:
+            self._structures = Structures(self)
+        return self._structures
+
 
+    @structures.setter
+    def structures(self, structures):
+        if self._structures:
+            self._structures.release(list(self._structures))
+        self.body = None
+        self._body_start = None
+        self._structures = Structures(self, structures)
+        self.touch()
 
-    def write(self, out, indent):
-        out.write(f'{indent}{self.datatype}')
+
+    @property
+    def children(self): # like structures but never creates the list
+        if self.body is not None:
+            self.parse_body()
+        return self._structures or ()
+
+
+    @property
+    def properties(self):
+        if self._properties is None:
+            self._properties = Properties(self)
+        return self._properties
+
+
+    @properties.setter
+    def properties(self, properties):
+        self._properties = Properties(self, properties)
+        self.touch()
+
+
+    @property
+    def has_properties(self):
+        return bool(self._properties)
+
+
+    @property
+    def local_names(self):
+        if self.body is not None:
+            self.parse_body()
+        if self._local_names is None:
+            self._local_names = {}
+        return self._local_names
+
+
+    def lookup(self, name):
+        if self.body is not None:
+            self.parse_body()
+        return self._local_names.get(name) if self._local_names else None
+
+
+    def parse_body(self):
+        oddl, text, pos = self.body
+        self.body = None
+        Parser(oddl, lazy=True).parse_lazy_body(self, text, pos)
+
+
+    def write_structure(self, writer, depth):
+        # Uses a stack of structures and closing braces to write rather
+        # than recursion so nesting depth is only limited by memory
+        stack = [(self, depth)]
+        while stack:
+            structure, depth = stack.pop()
+            if isinstance(structure, str): # closing brace
+                writer.write(structure)
+            elif isinstance(structure, PrimitiveStructure):
+                structure.write_structure(writer, depth)
+            else:
+                indent = writer.indent(depth)
+                writer.write(indent)
+                structure.write_header(writer)
+                children = structure.children
+                if children:
+                    writer.write(f'\n{indent}{{\n')
+                    stack.append((f'{indent}}}\n', depth))
+                    stack.extend((child, depth + 1)
+                                 for child in reversed(children))
+                else:
+                    writer.write(' {}\n')
+
+
+    def write_header(self, writer):
+        writer.write(self.datatype)
         if self.name is not None:
-            out.write(f' {self.name}')
-        self.write_properties(out)
-        out.write('\n')
-        if self.structures:
-            out.write(f'{indent}{{\n')
-            for structure in self.structures:
-                structure.write(out, indent + TAB)
-            out.write(f'{indent}}}\n')
+            writer.write(f' {self.name}')
+        self.write_properties(writer)
+
+
+    def body_items(self, start, end, depth):
+        # Returns the items for Structure.pieces()'s stack that give the
+        # text of this dirty structure whose source span is (start, end):
+        # if it is DIRTY only its header is written, and the text between
+        # its children is copied unless a child was removed or they were
+        # reordered (when that text is lost)
+        children = self.children
+        writer = Writer()
+        indent = writer.indent(depth)
+        inner = '\n' + writer.indent(depth + 1)
+        items = []
+        pos = start
+        if self.dirty == DIRTY:
+            self.write_header(writer)
+            writer.write(f'\n{indent}{{' if children else ' {')
+            items.append((writer.getvalue(), None, None))
+            pos = (None if self._body_start is None else
+                   start + self._body_start)
+        offsets = [child.offset for child in children
+                   if child.offset is not None]
+        if pos is None or any(offset >= next_offset for offset, next_offset
+                              in zip(offsets, offsets[1:])):
+            for child in children:
+                items += ((inner, None, None), (child, start, depth + 1))
+            items.append((f'\n{indent}}}' if children else '}', None, None))
+            return items
+        for child in children:
+            if child.offset is None: # added so written after the previous
+                items += ((inner, None, None), (child, start, depth + 1))
+                continue
+            child_start = start + child.offset
+            items += ((None, pos, child_start), (child, start, depth + 1))
+            pos = child_start + child.size
+        items.append((None, pos, end))
+        return items
 
 
     def write_properties(self, out):
-        if self.properties:
+        if self._properties:
             out.write(' (')
             sep = ''
             for name, value in self.properties.items():
@@ -249,19 +1693,930 @@ class DerivedStructure(Structure):
             out.write(')')
 
 
+def touching(method):
+    # Wraps a list or dict method so that it touches the container's owner
+    def touch(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.owner.touch()
+        return result
+    return touch
+
+
+def name_table(parent, name):
+    # Returns the name table of the parent's tree that a child's name
+    # belongs in: the parent's local names for a %name, the Oddl's global
+    # names for a $name (None if the parent isn't in an Oddl's tree)
+    if name.startswith('%'):
+        return parent.local_names
+    while isinstance(parent, Structure):
+        parent = parent.parent
+    return None if parent is None else parent.global_names
+
+
+def name_entries(parent, structures):
+    # Returns the (names, name, structure) entries the given children of
+    # the parent have in the name tables: theirs and their descendants'
+    # $names (unparsed bodies add theirs when parsed) and their %names
+    oddl = parent
+    while isinstance(oddl, Structure):
+        oddl = oddl.parent
+    entries = []
+    for structure in structures:
+        name = structure.name
+        if name is not None and name.startswith('%'):
+            entries.append((parent.local_names, name, structure))
+        if oddl is None:
+            continue
+        stack = [structure]
+        while stack:
+            structure = stack.pop()
+            name = structure.name
+            if name is not None and name.startswith('$'):
+                entries.append((oddl.global_names, name, structure))
+            stack += getattr(structure, '_structures', None) or ()
+    return entries
+
+
+class Structures(list):
+
+    # A list of structures that makes its owner the parent of those added
+    # and touches it when changed (parsing uses the list methods directly
+    # since it sets parents itself and nothing can be indexed yet)
+
+    __slots__ = ('owner',)
+
+    def __init__(self, owner, structures=()):
+        self.owner = owner # Oddl or DerivedStructure
+        super().__init__(self.adopt(structures))
+
+
+    def __reduce__(self):
+        return self.__class__, (self.owner, list(self))
+
+
+    def adopt(self, structures):
+        # A structure moved from another parent can't be copied from the
+        # source when saving incrementally so its source span is dropped;
+        # its names are moved to this tree's name tables (a duplicate
+        # raises Error before anything is changed)
+        owner = self.owner
+        structures = list(structures)
+        moved = [structure for structure in structures
+                 if structure.parent is not owner]
+        if not moved: # e.g., when unpickling
+            return structures
+        entries = name_entries(owner, moved)
+        seen = set()
+        for names, name, structure in entries:
+            if (names.get(name, structure) is not structure or
+                    (id(names), name) in seen):
+                raise Error(f'duplicate name {name}')
+            seen.add((id(names), name))
+        for structure in moved:
+            if structure.parent is not None:
+                for names, name, item in name_entries(structure.parent,
+                                                      (structure,)):
+                    if names.get(name) is item:
+                        del names[name]
+            structure.parent = owner
+            structure.offset = None
+        for names, name, structure in entries:
+            names[name] = structure
+        return structures
+
+
+    def release(self, structures):
+        # Drops the names of structures removed from the list from the
+        # name tables and unparents them
+        owner = self.owner
+        for names, name, structure in name_entries(owner, structures):
+            if names.get(name) is structure:
+                del names[name]
+        for structure in structures:
+            if structure.parent is owner:
+                structure.parent = None
+
+
+    def removed(self, structures):
+        # Called after structures were removed; the text between the rest
+        # may hold theirs so it can no longer be copied when saving
+        # incrementally
+        self.release(structures)
+        if isinstance(self.owner, DerivedStructure):
+            self.owner._body_start = None
+        self.owner.touch()
+
+
+    def __setitem__(self, index, value):
+        old = self[index] if isinstance(index, slice) else [self[index]]
+        value = self.adopt(value if isinstance(index, slice) else (value,))
+        super().__setitem__(index, value if isinstance(index, slice)
+                            else value[0])
+        self.removed([structure for structure in old
+                      if all(structure is not item for item in value)])
+
+
+    def __delitem__(self, index):
+        old = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        self.removed(old)
+
+
+    def __imul__(self, count):
+        old = list(self) if count < 1 else []
+        super().__imul__(count)
+        self.removed(old)
+        return self
+
+
+    def __iadd__(self, structures):
+        self.extend(structures)
+        return self
+
+
+    def append(self, structure):
+        super().append(self.adopt((structure,))[0])
+        self.owner.touch()
+
+
+    def extend(self, structures):
+        super().extend(self.adopt(structures))
+        self.owner.touch()
+
+
+    def insert(self, index, structure):
+        super().insert(index, self.adopt((structure,))[0])
+        self.owner.touch()
+
+
+    def pop(self, index=-1):
+        structure = super().pop(index)
+        self.removed([structure])
+        return structure
+
+
+    def remove(self, structure):
+        super().remove(structure)
+        self.removed([structure])
+
+
+    def clear(self):
+        old = list(self)
+        super().clear()
+        self.removed(old)
+
+
+    sort = touching(list.sort)
+    reverse = touching(list.reverse)
+
+
+class Properties(dict):
+
+    # A dict of property values that touches its owner when changed
+
+    __slots__ = ('owner',)
+
+    def __init__(self, owner, properties=()):
+        super().__init__(properties)
+        self.owner = owner # DerivedStructure
+
+
+    def __reduce__(self):
+        return self.__class__, (self.owner, dict(self))
+
+
+    __setitem__ = touching(dict.__setitem__)
+    __delitem__ = touching(dict.__delitem__)
+    if hasattr(dict, '__ior__'): # Python 3.9+
+        __ior__ = touching(dict.__ior__)
+    update = touching(dict.update)
+    setdefault = touching(dict.setdefault)
+    pop = touching(dict.pop)
+    popitem = touching(dict.popitem)
+    clear = touching(dict.clear)
+
+
+class Index:
+
+    # Every structure in a tree in document order, and those with each
+    # datatype, property, and (property, value); a query's candidates are
+    # taken from the shortest applicable list so that its cost depends on
+    # the number of matches rather than on the size of the tree
+
+    def __init__(self, root):
+        self.structures = []
+        self.by_datatype = collections.defaultdict(list)
+        self.by_property = collections.defaultdict(list) # name or
+                                                         # (name, value)
+        stack = list(reversed(root.children))
+        while stack:
+            structure = stack.pop()
+            self.structures.append(structure)
+            self.by_datatype[structure.datatype].append(structure)
+            if isinstance(structure, DerivedStructure):
+                for name, value in (structure._properties or {}).items():
+                    self.by_property[name].append(structure)
+                    self.by_property[name, value].append(structure)
+                stack.extend(reversed(structure.children))
+
+
+    def candidates(self, datatype, predicates):
+        candidates = self.structures
+        if datatype is not None:
+            candidates = self.by_datatype.get(datatype, ())
+        for name, value in predicates:
+            key = name if value is Query.ANY else (name, value)
+            structures = self.by_property.get(key, ())
+            if len(structures) < len(candidates):
+                candidates = structures
+        return candidates
+
+
+class Query:
+
+    # A compiled select() pattern:
+    #   pattern ::= "//"? step (("/" | "//") step)*
+    #   step ::= (data-type | identifier | "*") predicate*
+    #   predicate ::= "[" identifier ("=" property-value)? "]"
+
+    ANY = object() # a predicate with no value matches any value
+
+    @classmethod
+    @functools.lru_cache(maxsize=256) # bounded as patterns may be made
+    def get(Class, pattern):
+        return Class(pattern)
+
+
+    def __init__(self, pattern):
+        self.steps = [] # (descendant, datatype or None, predicates)
+        parser = Parser(Oddl())
+        lexer = parser.lexer = Lexer(pattern)
+
+        def skip(): # whitespace only since // isn't a comment here
+            lexer.match('space', SPACE_RX)
+            return not lexer.at_end
+
+        skip()
+        descendant = lexer.accept('//')
+        while True:
+            skip()
+            datatype = parser.parse_value(DataType)
+            if datatype is None and not lexer.accept('*'):
+                token = lexer.match('identifier', ID_RX)
+                if token is None:
+                    parser.error('expected data-type or \'*\'')
+                datatype = lexer.value(token)
+            predicates = []
+            while skip() and lexer.accept('['):
+                skip()
+                token = lexer.match('identifier', ID_RX)
+                if token is None:
+                    parser.error('expected property')
+                name = lexer.value(token)
+                value = self.ANY
+                skip()
+                if lexer.accept('='):
+                    skip()
+                    value = parser.parse_property_value(name)
+                    skip()
+                if not lexer.accept(']'):
+                    parser.error('expected \']\'')
+                predicates.append((name, value))
+            self.steps.append((descendant, datatype, tuple(predicates)))
+            if not skip():
+                break
+            if lexer.accept('//'):
+                descendant = True
+            elif lexer.accept('/'):
+                descendant = False
+            else:
+                parser.error('expected \'/\', \'//\', or \'[\'')
+
+
+    def select(self, context):
+        root = context
+        while root.parent is not None:
+            root = root.parent
+        index = root.index if isinstance(root, Oddl) else Index(root)
+        last = len(self.steps) - 1
+        _, datatype, predicates = self.steps[last]
+        return [structure for structure in
+                index.candidates(datatype, predicates)
+                if self.matches(structure, last, context)]
+
+
+    def matches(self, structure, i, context):
+        # Matches the steps from the last (i.e., from the bottom up)
+        descendant, datatype, predicates = self.steps[i]
+        if datatype is not None and structure.datatype != datatype:
+            return False
+        if predicates:
+            properties = getattr(structure, '_properties', None) or {}
+            for name, value in predicates:
+                if name not in properties:
+                    return False
+                if value is not self.ANY and not same(properties[name],
+                                                      value):
+                    return False
+        parent = structure.parent
+        if i == 0:
+            while parent is not None:
+                if parent is context:
+                    return True
+                if not descendant:
+                    return False
+                parent = parent.parent
+            return False
+        while parent is not context and isinstance(parent, Structure):
+            if self.matches(parent, i - 1, context):
+                return True
+            if not descendant:
+                break
+            parent = parent.parent
+        return False
+
+
+class Writer:
+
+    def __init__(self, out=None, chunksize=None):
+        # If out is None the output is held for getvalue(), otherwise it is
+        # written to out whenever chunksize characters have accumulated
+        self.out = out
+        self.chunksize = chunksize or WRITE_CHUNK_SIZE
+        self.chunks = []
+        self.size = 0
+        self.indents = ['']
+
+
+    def indent(self, depth):
+        indents = self.indents
+        while len(indents) <= depth:
+            indents.append(indents[-1] + TAB)
+        return indents[depth]
+
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.chunksize and self.out is not None:
+            self.flush()
+
+
+    def flush(self):
+        if self.out is not None and self.chunks:
+            self.out.write(''.join(self.chunks))
+            self.chunks.clear()
+            self.size = 0
+
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class Cache:
+
+    # A side-car binary image of a parsed file: a header, a string table,
+    # the tree as a flat array of int64s, and an 8-byte aligned blob
+    # holding numeric data raw (so it can be used in place when mmap-ed)
+    # and base-64 data decoded
+    MAGIC = b'ODDLC\x00\x00\x02'
+    HEADER = struct.Struct('<8s?7xQqQQQQQ32s') # magic, big-endian, source
+        # size, source mtime, string count, string bytes, int count, blob
+        # offset, blob size, source sha256
+    DERIVED, PRIMITIVE = range(2)
+    FALSE, TRUE, INT, BIG_INT, REAL, STRING, REFERENCE, DATATYPE, \
+        BASE64 = range(9)
+
+    def __init__(self, filename, cachename=None):
+        self.filename = filename
+        self.cachename = cachename or f'{filename}c'
+
+
+    def load(self, oddl):
+        # Returns True if the cache is up to date with its source and has
+        # been loaded into the oddl
+        try:
+            stat = os.stat(self.filename)
+            with open(self.cachename, 'rb') as file:
+                image = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return False
+        try:
+            (magic, bigendian, size, mtime, string_count, strings_size,
+             int_count, blob_offset, blob_size,
+             digest) = self.HEADER.unpack_from(image)
+            if (magic != self.MAGIC or
+                    bigendian != (sys.byteorder == 'big') or
+                    size != stat.st_size or
+                    len(image) != blob_offset + blob_size): # e.g., truncated
+                return False
+            if mtime != stat.st_mtime_ns and digest != self.digest():
+                return False
+            view = memoryview(image)
+            pos = self.HEADER.size
+            end = pos + string_count * 8
+            lengths = view[pos:end].cast('q')
+            if sum(lengths) != strings_size:
+                return False
+            strings = []
+            for length in lengths:
+                strings.append(str(view[end:end + length], 'utf-8'))
+                end += length
+            pos = aligned(end)
+            ints = view[pos:pos + int_count * 8].cast('q')
+            oddl.clear()
+            self.decode(oddl, ints, strings, view[blob_offset:])
+            return True
+        except (struct.error, IndexError, TypeError, ValueError,
+                UnicodeDecodeError, Error):
+            oddl.clear()
+            return False
+
+
+    def digest(self):
+        hasher = hashlib.sha256()
+        with open(self.filename, 'rb') as file:
+            while True:
+                data = file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+        return hasher.digest()
+
+
+    def save(self, oddl, stat, digest):
+        # Writes the cache via a temporary file; failure isn't an error
+        # since the cache is only an optimization
+        ints = array.array('q')
+        strings = {}
+        blob = bytearray()
+        self.encode(oddl, ints, strings, blob)
+        lengths = array.array('q')
+        text = bytearray()
+        for string in strings:
+            data = string.encode('utf-8')
+            lengths.append(len(data))
+            text += data
+        pos = self.HEADER.size + len(lengths) * 8 + len(text)
+        pad = aligned(pos) - pos
+        blob_offset = aligned(pos + pad + len(ints) * 8)
+        header = self.HEADER.pack(
+            self.MAGIC, sys.byteorder == 'big', stat.st_size,
+            stat.st_mtime_ns, len(lengths), len(text), len(ints),
+            blob_offset, len(blob), digest)
+        temp = f'{self.cachename}.{os.getpid()}.tmp'
+        try:
+            with open(temp, 'wb') as file:
+                for data in (header, lengths, text, bytes(pad), ints):
+                    file.write(data)
+                file.write(bytes(blob_offset - file.tell()))
+                file.write(blob)
+            os.replace(temp, self.cachename)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp)
+
+
+    def encode(self, oddl, ints, strings, blob):
+        def string(value):
+            index = strings.get(value)
+            if index is None:
+                index = strings[value] = len(strings)
+            return index
+
+        def encode_value(value):
+            if value is True or value is False:
+                ints.append(self.TRUE if value else self.FALSE)
+            elif isinstance(value, Base64Data):
+                data = value.data
+                ints.extend((self.BASE64, len(blob), len(data)))
+                blob.extend(data)
+            elif isinstance(value, int):
+                if -(1 << 63) <= value < (1 << 63):
+                    ints.extend((self.INT, value))
+                else:
+                    ints.extend((self.BIG_INT, string(str(value))))
+            elif isinstance(value, float):
+                ints.extend((self.REAL, struct.unpack(
+                    '=q', struct.pack('=d', value))[0]))
+            elif isinstance(value, Reference):
+                ints.extend((self.REFERENCE, string(value)))
+            elif isinstance(value, DataType):
+                ints.extend((self.DATATYPE, string(value)))
+            else:
+                ints.extend((self.STRING, string(value)))
+
+        structures = oddl.structures
+        ints.append(len(structures))
+        stack = list(reversed(structures))
+        while stack:
+            structure = stack.pop()
+            name = -1 if structure.name is None else string(structure.name)
+            if isinstance(structure, DerivedStructure):
+                properties = (structure.properties if
+                              structure.has_properties else {})
+                ints.extend((self.DERIVED, string(structure.datatype), name,
+                             len(properties)))
+                for key, value in properties.items():
+                    ints.append(string(key))
+                    encode_value(value)
+                children = structure.children
+                ints.append(len(children))
+                stack.extend(reversed(children))
+            else:
+                size = structure.dataarraylistsize
+                data = structure.data or ()
+                ints.extend((self.PRIMITIVE, string(structure.datatype),
+                             name, -1 if size is None else size,
+                             structure.dataarrayliststates, len(data)))
+                if structure.typecode is None:
+                    for value in data:
+                        encode_value(value)
+                else:
+                    blob.extend(bytes(aligned(len(blob)) - len(blob)))
+                    ints.append(len(blob))
+                    blob.extend(memoryview(data).cast('B'))
+                if structure.dataarrayliststates:
+                    ints.extend(-1 if state is None else string(state)
+                                for state in structure.states)
+
+
+    def decode(self, oddl, ints, strings, blob):
+        pos = 0
+
+        def take():
+            nonlocal pos
+            pos += 1
+            return ints[pos - 1]
+
+        def decode_value(holder):
+            tag = take()
+            if tag <= self.TRUE:
+                return tag == self.TRUE
+            if tag == self.INT:
+                return Int(take())
+            if tag == self.REAL:
+                return Real(struct.unpack('=d', struct.pack('=q',
+                                                            take()))[0])
+            if tag == self.BASE64:
+                start = take()
+                return Base64Data.frombytes(blob[start:start + take()])
+            value = strings[take()]
+            if tag == self.BIG_INT:
+                return Int(value)
+            if tag == self.STRING:
+                return String(value)
+            if tag == self.DATATYPE:
+                return DataType(value)
+            value = Reference(value)
+            if not value.isnull:
+                oddl.references.append((holder, value))
+            return value
+
+        stack = [[oddl, take()]] # [parent, structures still to decode]
+        while stack:
+            parent, count = stack[-1]
+            if not count:
+                stack.pop()
+                continue
+            stack[-1][1] -= 1
+            kind = take()
+            datatype = strings[take()]
+            if kind == self.DERIVED:
+                structure = DerivedStructure(datatype)
+            else:
+                structure = PrimitiveStructure(DataType(datatype))
+            structure.parent = parent
+            list.append(parent.structures, structure)
+            name = take()
+            if name != -1:
+                structure._name = name = strings[name]
+                names = (oddl.global_names if name.startswith('$') else
+                         parent.local_names)
+                names[name] = structure
+            if kind == self.DERIVED:
+                for _ in range(take()):
+                    key = strings[take()]
+                    dict.__setitem__(structure.properties, key,
+                                     decode_value(structure))
+                stack.append([structure, take()])
+                continue
+            size = take()
+            if size != -1:
+                structure._dataarraylistsize = size
+            structure._dataarrayliststates = states = bool(take())
+            count = take()
+            typecode = structure.typecode
+            if typecode is None:
+                structure._data = [decode_value(structure)
+                                   for _ in range(count)]
+            else:
+                start = take()
+                end = start + count * array.array(typecode).itemsize
+                structure._data = blob[start:end].cast(typecode)
+            if states:
+                structure._states = [None if index == -1 else strings[index]
+                                     for index in (take() for _ in range(
+                                         count // size))]
+
+
+class LintCache:
+
+    # A directory holding the result of checking each file as a small
+    # JSON file named by a SHA-256 of the library version, the filename
+    # (which messages include), and the file's content; since a change to
+    # any of these gives a new name, entries are never stale and the
+    # directory may be pruned or deleted at any time
+
+    def __init__(self, directory=None):
+        self.directory = (lint_cache_directory() if directory is None
+                          else directory)
+
+
+    def key(self, filename):
+        hasher = hashlib.sha256(
+            f'{__version__}\0{filename}\0'.encode('utf-8'))
+        with open(filename, 'rb') as file:
+            while True:
+                data = file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+        return hasher.hexdigest()
+
+
+    def get(self, key):
+        # Returns the (ok, messages) result for the key or None
+        if not self.directory:
+            return None
+        try:
+            with open(os.path.join(self.directory, key), 'rt',
+                      encoding='utf-8') as file:
+                result = json.load(file)
+            return bool(result['ok']), [str(message) for message in
+                                        result['messages']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+
+    def put(self, key, ok, messages):
+        # Writes the result via a temporary file; failure isn't an error
+        # since the cache is only an optimization
+        filename = os.path.join(self.directory, key)
+        temp = f'{filename}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp, 'wt', encoding='utf-8') as file:
+                json.dump(dict(ok=ok, messages=messages), file)
+            os.replace(temp, filename)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp)
+
+
+class Lexer:
+
+    def __init__(self, text, lino=1, column=1):
+        self.text = text
+        self.pos = 0
+        self.lino = lino # of the start of the text
+        self.column = column # of the start of the text
+        self.offset = 0 # of the start of the text in the whole text
+        self.newlines = None # offsets of every newline (built on demand)
+
+
+    def location(self, pos=None):
+        # Line numbers aren't tracked while lexing but computed from a
+        # newline table built at most once per text, i.e., only if a
+        # diagnostic or source location is actually needed
+        if pos is None:
+            pos = self.pos
+        if self.newlines is None:
+            self.newlines = array.array(
+                'q', (match.start() for match in
+                      self.regex(NEWLINE_RX).finditer(self.text)))
+        i = bisect.bisect_left(self.newlines, pos)
+        if i:
+            return self.lino + i, pos - self.newlines[i - 1]
+        return self.lino, pos + self.column
+
+
+    def extend(self, pos, text):
+        # Drops the text before pos and appends the given text
+        lines = self.text.count('\n', 0, pos)
+        if lines:
+            self.lino += lines
+            self.column = 1
+        self.column += pos - self.text.rfind('\n', 0, pos) - 1
+        self.text = self.text[pos:] + text
+        self.offset += pos
+        self.pos = 0
+        self.newlines = None
+
+
+    @property
+    def at_end(self):
+        return self.pos >= len(self.text)
+
+
+    def peek(self):
+        return self.text[self.pos:self.pos + 1]
+
+
+    def startswith(self, what):
+        return self.text.startswith(what, self.pos)
+
+
+    def accept(self, what):
+        if self.startswith(what):
+            self.pos += len(what)
+            return True
+        return False
+
+
+    def regex(self, regex):
+        return regex
+
+
+    def match(self, kind, regex):
+        # Matches in place so that no copy of the rest of the text is made
+        match = regex.match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            return Token(kind, match.start(), self.pos)
+
+
+    def scan(self, regex):
+        # Returns the regex's match at pos without moving
+        return regex.match(self.text, self.pos)
+
+
+    def value(self, token):
+        return self.text[token.start:token.end]
+
+
+    def slice(self, start, end):
+        return self.text[start:end]
+
+
+    def string(self, start, end):
+        return self.text[start:end]
+
+
+    def skip_ws_and_comments(self):
+        match = WS_RX.match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+
+
+    def skip_structure(self):
+        # Moves to just past the closing brace of the structure that
+        # starts at pos, without parsing it; returns False and leaves pos
+        # unchanged if the text ends first
+        text = self.text
+        pos = self.pos
+        depth = 0
+        scan = self.regex(SCAN_RX).match
+        while True:
+            match = scan(text, pos)
+            if match is None: # at the end or inside a string or comment
+                return False
+            pos = match.end()
+            group = match.lastindex
+            if group == 1: # an innermost {...}, e.g., data
+                if depth == 0:
+                    self.pos = match.end(1)
+                    return True
+            elif group == 2: # {
+                depth += 1
+            elif group == 3: # }
+                depth -= 1
+                if depth <= 0:
+                    self.pos = pos
+                    return True
+            elif group == 4: # base-64-data may hold // or /*
+                pos = self.skip_base64(text, match.start())
+
+
+    def skip_base64(self, text, pos):
+        # Steps over the base-64 data list or property value (if any) that
+        # starts at pos the way the parser reads it, and returns where to
+        # scan on from: its text may hold // and /* which are not comments
+        found = self.regex(BASE64_START_RX).match(text, pos)
+        if found is None: # e.g., the b of an identifier
+            return pos + 1
+        pos = found.end()
+        skip_ws = self.regex(WS_RX).match
+        base64 = self.regex(Base64Data.REGEX).match
+        if found.lastindex == 1: # = so maybe a property value
+            match = skip_ws(text, pos)
+            if match is not None:
+                pos = match.end()
+            if self.regex(NOT_BASE64_VALUE_RX).match(text, pos) is None:
+                match = base64(text, pos)
+                if match is not None:
+                    pos = match.end()
+            return pos
+        match = self.regex(BASE64_HEADER_RX).match(text, found.start())
+        if match is None: # not a primitive structure after all
+            return pos
+        arrays = match.lastindex == 1 # each may start with a state
+        start = pos = match.end() # just past the data (array) list's {
+        item = self.regex(BASE64_ITEM_RX).match
+        state = self.regex(ID_RX).match
+        depth = 0
+        while True:
+            match = skip_ws(text, pos)
+            if match is not None:
+                pos = match.end()
+            match = item(text, pos) or (state if arrays and not depth
+                                        else base64)(text, pos)
+            if match is None: # invalid or cut short so scan it as before
+                return start - 1
+            pos = match.end()
+            group = match.lastindex
+            if group == 1: # { of a data array
+                depth += 1
+            elif group == 2: # }
+                if depth == 0:
+                    return pos
+                depth -= 1
+
+
+class BytesLexer(Lexer):
+
+    # Lexes UTF-8 bytes (or an mmap of them) in place using bytes versions
+    # of the regexes; tokens are all ASCII so only string literals need
+    # to be decoded as UTF-8, and only when they are reached
+
+    def peek(self):
+        return self.text[self.pos:self.pos + 1].decode('latin-1')
+
+
+    def startswith(self, what):
+        what = what.encode('ascii')
+        return self.text[self.pos:self.pos + len(what)] == what
+
+
+    def regex(self, regex):
+        bytes_regex = BYTES_FOR_RX.get(regex)
+        if bytes_regex is None:
+            bytes_regex = BYTES_FOR_RX[regex] = re.compile(
+                regex.pattern.encode('ascii'), regex.flags & ~re.UNICODE)
+        return bytes_regex
+
+
+    def match(self, kind, regex):
+        return super().match(kind, self.regex(regex))
+
+
+    def scan(self, regex):
+        return self.regex(regex).match(self.text, self.pos)
+
+
+    def value(self, token):
+        return self.text[token.start:token.end].decode('ascii')
+
+
+    def slice(self, start, end):
+        return self.text[start:end].decode('utf-8', 'replace')
+
+
+    def string(self, start, end): # may raise UnicodeDecodeError
+        return self.text[start:end].decode('utf-8')
+
+
+    def skip_ws_and_comments(self):
+        match = self.regex(WS_RX).match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+
+
+Token = collections.namedtuple('Token', 'kind start end')
+
+
 class Parser:
 
-    def __init__(self, oddl):
+    def __init__(self, oddl, *, lazy=False):
         self.oddl = oddl
-        self.clear()
+        self.lazy = lazy
+        self.lexer = Lexer('')
+        self.stack = [oddl]
+        self.starts = [0] # source offset of each structure in the stack
 
 
     def clear(self):
         self.oddl.clear()
-        self.text = ''
-        self.pos = 0
-        self.lino = 1
+        self.lexer = Lexer('')
         self.stack = [self.oddl]
+        self.starts = [0]
+
+
+    def new_lexer(self, text, lino=1, column=1):
+        # text may be a str or UTF-8 bytes, bytearray, or mmap
+        if isinstance(text, str):
+            return Lexer(text, lino, column)
+        return BytesLexer(text, lino, column)
 
 
     @property
@@ -272,12 +2627,100 @@ class Parser:
     def parse(self, text):
         # file ::= structure*
         self.clear()
-        self.text = text.rstrip()
-        while self.pos < len(self.text):
-            self.parse_structure(optional=True)
+        self.lexer = self.new_lexer(text)
+        while self.advance(True, 'structure expected'):
+            self.parse_structure()
 
 
-    def parse_structure(self, *, optional=False):
+    def parse_parallel(self, text, jobs):
+        # Finds the top-level structures with a brace scan, and parses
+        # batches of them in worker processes, then merges the results; if
+        # the text is an mmap of the file each worker maps the file too
+        # (so they share the page cache) rather than being sent its text
+        self.clear()
+        lexer = self.lexer = self.new_lexer(text)
+        batches = []
+        size = len(text) // (jobs * 4) + 1
+        start = None
+        while self.advance(True, 'structure expected'):
+            pos = lexer.pos
+            if not lexer.skip_structure():
+                self.parse_structure() # to report the error
+            if start is None:
+                start = pos
+            if lexer.pos - start >= size:
+                batches.append((start, lexer.pos))
+                start = None
+        if start is not None:
+            batches.append((start, lexer.pos))
+        if len(batches) < 2:
+            lexer.pos = 0
+            while self.advance(True, 'structure expected'):
+                self.parse_structure()
+            return
+        oddl = self.oddl
+        mapped = isinstance(text, mmap.mmap) and oddl.filename
+        with concurrent.futures.ProcessPoolExecutor(
+                min(jobs, len(batches))) as executor:
+            futures = [executor.submit(parse_mapped_piece, oddl.filename,
+                                       start, end) if mapped else
+                       executor.submit(parse_piece, oddl.filename,
+                                       text[start:end],
+                                       *lexer.location(start))
+                       for start, end in batches]
+            for future, (start, _) in zip(futures, batches):
+                self.merge(unflatten(future.result()),
+                           0 if mapped else start)
+
+
+    def merge(self, piece, offset=0):
+        # Adds the structures, names and references parsed into another
+        # Oddl (e.g., by a worker process) from the text at the given
+        # offset to this parser's Oddl
+        oddl = self.oddl
+        for structure in piece.structures:
+            structure.parent = oddl
+            structure.offset += offset
+        list.extend(oddl.structures, piece.structures)
+        for names, new_names in ((oddl.global_names, piece.global_names),
+                                 (oddl.local_names, piece.local_names)):
+            for name in new_names:
+                if name in names:
+                    self.error(f'duplicate name {name}',
+                               new_names[name].source_span()[0])
+            names.update(new_names)
+        oddl.references += piece.references
+
+
+    def iterparse(self, file, chunksize):
+        # Yields each top-level structure as soon as all its text has been
+        # read; the buffer only holds the text of the unparsed structures
+        self.clear()
+        lexer = self.lexer
+        eof = False
+        size = chunksize
+        while True:
+            pos = lexer.pos
+            lexer.skip_ws_and_comments()
+            start = lexer.pos
+            if not eof and (lexer.at_end or not lexer.skip_structure()):
+                # Incomplete: drop what has been parsed and read more,
+                # doubling each time so huge structures are scanned O(n)
+                chunk = file.read(size)
+                size *= 2
+                eof = not chunk
+                lexer.extend(pos, chunk)
+                continue
+            lexer.pos = start
+            if not self.advance(True, 'structure expected'):
+                return
+            size = chunksize
+            self.starts[0] = -lexer.offset # so offsets are in the file
+            self.parse_structure()
+            yield self.oddl.structures[-1]
+
+
+    def parse_structure(self):
         # structure ::=
         #   data-type (name? "{" data-list? "}"
         #              | "[" integer-literal "]" "*"? name?
@@ -285,354 +2728,1207 @@ class Parser:
         #   |
         #   identifier name? ("(" (property ("," property)*)? ")")?
         #                     "{" structure* "}"
-        text = self.advance(optional, 'structure expected')
-        if not text:
-            return
+        # Nested structures are parsed using the stack rather than by
+        # recursion so nesting depth is only limited by memory
+        if self.open_structure():
+            self.parse_body()
+            self.close_structure()
+
+
+    def open_structure(self):
+        # Parses a structure up to its body (or to its end if it has no
+        # body to parse) and makes it the current structure; returns True
+        # if its body is still to be parsed, else closes it
+        start = self.lexer.pos
         value = self.parse_value(DataType)
         if value is not None:
-            # Append to current structure's list of structures
-            self.current.structures.append(PrimitiveStructure(value))
-            self.parse_primitive_structure_content()
+            structure = PrimitiveStructure(value)
+            content = self.parse_primitive_structure_content
         else:
-            match = RESERVED_STRUCTURE_ID_RX.match(text)
-            if match is not None:
-                self.error(f'illegal structure name {match[0]}')
-            match = ID_RX.match(text)
-            if match is not None:
-                datatype = match[0]
-                self.pos += len(datatype)
-                # Append to current structure's list of structures and make
-                # this structure the new current structure when parsing its
-                # content since DerivedStructures can nest
-                structure = DerivedStructure(datatype)
-                self.current.structures.append(structure)
-                self.stack.append(structure)
-                self.parse_derived_structure_content()
-                self.stack.pop()
-            else:
+            token = self.lexer.match('identifier', ID_RX)
+            if token is None:
                 self.error('primitive or derived structure expected')
-
-
-    # TODO #######################
-    def parse_primitive_structure_content(self, *, optional=False):
+            datatype = sys.intern(self.lexer.value(token))
+            if RESERVED_STRUCTURE_ID_RX.fullmatch(datatype):
+                self.error(f'illegal structure name {datatype}')
+            structure = DerivedStructure(datatype)
+            content = self.parse_derived_structure_content
+        # Append to current structure's list of structures and make this
+        # structure the new current structure when parsing its content
+        # since DerivedStructures can nest
+        structure.parent = self.current
+        list.append(self.current.structures, structure)
+        self.stack.append(structure)
+        self.starts.append(start)
+        if content():
+            return True
+        self.close_structure()
+        return False
+
+
+    def close_structure(self):
+        structure = self.stack.pop()
+        start = self.starts.pop()
+        structure.offset = start - self.starts[-1]
+        structure.size = self.lexer.pos - start
+
+
+    def parse_primitive_structure_content(self):
         # "[" integer-literal "]" "*"? name? "{" data-array-list? "}"
         # |
         # name? "{" data-list? "}"
         # NOTE data-list and data-array-list are lists of elements of the
         # same type, i.e., of datatype type
-        text = self.advance(optional,
-                            'expected primitive structure content')
-        if not text:
-            return
-        if text[0] == '[':
-            text = self.expect('[')
+        structure = self.current
+        self.advance(False, 'expected primitive structure content')
+        if self.lexer.accept('['):
+            self.advance(False, 'expected array size')
             value = self.parse_number()
-            if isinstance(value, Real):
-                self.error('expected integer')
-            self.current.dataarraylistsize = value
-            text = self.expect(']')
-            if text.startswith('*'):
-                self.current.dataarrayliststates = True
-                self.pos += 1
-                text = text[1:]
-            # name = self.parse_name(optional=True)
-            # if name:
-            #   pass # where does this name go?
-            # text = self.expect('{')
-            # parse optional data-array-list
-            # self.expect('}')
+            if not isinstance(value, int) or value < 1:
+                self.error('expected positive integer array size')
+            structure._dataarraylistsize = value
+            self.expect(']')
+            self.advance(False, 'expected primitive structure content')
+            if self.lexer.accept('*'):
+                structure._dataarrayliststates = True
+            self.parse_name()
+            self.expect('{')
+            if structure.dataarrayliststates or not self.parse_bulk_data(
+                    BULK_ARRAY_LIST_RX):
+                self.parse_data_array_list()
         else:
-            name = self.parse_name(optional=True)
-            if name:
-                self.current.name = name
-            # text = self.expect('{')
-            # TODO parse_data_list(optional=True)
-            # self.expect('}')
-
-
-    def parse_derived_structure_content(self, *, optional=False):
-        # name? ("(" (property ("," property)*)? ")")? "{" structure* "}"
-        text = self.advance(optional, 'expected derived structure content')
-        if not text:
-            return
-        name = self.parse_name(optional=True)
-        if name:
-            self.current.name = name
-        self.parse_property_list(optional=True)
-        text = self.expect('{')
-        while self.pos < len(self.text):
-            self.parse_structure(optional=True)
+            self.parse_name()
+            self.expect('{')
+            if not self.parse_bulk_data(BULK_LIST_RX):
+                structure._data = structure.make_data(
+                    self.parse_data_list())
         self.expect('}')
 
 
-    def parse_name(self, *, optional=False):
-        text = self.advance(optional, 'expected name')
-        if not text:
-            return
-        match = NAME_RX.match(text)
+    def parse_bulk_data(self, regexes):
+        # Fast path for data (array) lists of plain decimal numbers (the
+        # bulk of most files): the whole run up to the closing brace is
+        # checked by one regex match and converted in one go; returns
+        # False to use the general path (e.g., for hex, char-literals,
+        # underscores, or comments)
+        structure = self.current
+        regex = regexes.get(structure.datatype)
+        if regex is None:
+            return False
+        lexer = self.lexer
+        match = lexer.scan(regex)
         if match is None:
-            if optional:
-                return
-            self.error('expected name')
-        name = match[0]
-        self.pos += len(name)
-        return name
+            return False
+        run = lexer.value(Token('data', *match.span()))
+        size = structure.dataarraylistsize
+        if size is not None:
+            rows = BULK_ROW_RX.findall(run)
+            for row in rows:
+                if row.count(',') != size - 1:
+                    return False # let the general path report the error
+            run = ','.join(rows)
+        if not run or run.isspace():
+            values = ()
+        elif structure.typecode in {'f', 'd'}:
+            values = self.parse_bulk_floats(run, structure.typecode)
+        else:
+            values = map(int, run.split(','))
+        try:
+            structure._data = structure.make_data(values)
+        except Error:
+            return False # let the general path report the error
+        lexer.pos = match.end()
+        return True
+
+
+    def parse_bulk_floats(self, run, typecode):
+        # Large runs are converted by NumPy straight into the array's
+        # buffer rather than via a list of Python floats
+        if numpy is not None and len(run) > NUMPY_THRESHOLD:
+            values = numpy.fromstring(run, dtype=numpy.float64, sep=',')
+            if len(values) == run.count(',') + 1:
+                data = array.array(typecode)
+                data.frombytes(values.astype(typecode).tobytes())
+                return data
+        return map(float, run.split(','))
+
+
+    def parse_data_list(self, values=None):
+        # data-list ::= value ("," value)*
+        datatype = self.current.datatype
+        parse = self.datum_parser(datatype)
+        if values is None:
+            values = []
+        self.advance(False, 'expected data or \'}\'')
+        if self.lexer.peek() == '}':
+            return values
+        while True:
+            values.append(parse(datatype))
+            self.advance(False, 'expected \',\' or \'}\'')
+            if not self.lexer.accept(','):
+                return values
+            self.advance(False, 'expected data')
+            if self.lexer.peek() == '}':
+                self.error('expected data after \',\'')
+
+
+    def parse_data_array_list(self):
+        # data-array-list ::=
+        #   identifier? "{" data-list "}" ("," identifier? "{" data-list "}")*
+        # The arrays are stored end-to-end in one flat list
+        structure = self.current
+        size = structure.dataarraylistsize
+        states = [] if structure.dataarrayliststates else None
+        values = []
+        self.advance(False, 'expected data array or \'}\'')
+        while self.lexer.peek() != '}':
+            if states is not None:
+                token = self.lexer.match('identifier', ID_RX)
+                states.append(None if token is None
+                              else sys.intern(self.lexer.value(token)))
+            self.expect('{')
+            count = len(values)
+            self.parse_data_list(values)
+            count = len(values) - count
+            if count != size:
+                self.error(f'expected {size} data array elements, got '
+                           f'{count}')
+            self.expect('}')
+            self.advance(False, 'expected \',\' or \'}\'')
+            if not self.lexer.accept(','):
+                break
+            self.advance(False, 'expected data array')
+            if self.lexer.peek() == '}':
+                self.error('expected data array after \',\'')
+        structure._data = structure.make_data(values)
+        structure._states = states
+
+
+    def datum_parser(self, datatype):
+        if datatype in INT_TYPES:
+            return self.parse_int_datum
+        if datatype in FLOAT_TYPES:
+            return self.parse_float_datum
+        return {'b': self.parse_bool_datum, 's': self.parse_string_datum,
+                'r': self.parse_reference_datum,
+                't': self.parse_datatype_datum,
+                'z': self.parse_base64_datum}[datatype]
+
+
+    def parse_bool_datum(self, _datatype):
+        token = self.lexer.match('bool', BOOL_RX)
+        if token is None:
+            self.error('expected bool')
+        return self.lexer.value(token) == 'true'
+
+
+    def parse_int_datum(self, datatype):
+        value = self.parse_number()
+        if not isinstance(value, int):
+            self.error('expected integer')
+        low, high = INT_RANGE[datatype]
+        if not low <= value <= high:
+            self.error(f'integer {value} out of range for {datatype}')
+        return value
+
+
+    def parse_float_datum(self, datatype):
+        value = self.parse_number(datatype)
+        if value is None:
+            self.error('expected float')
+        return value if isinstance(value, Real) else Real(value)
 
 
-    def parse_property_list(self, *, optional=False):
-        text = self.advance(optional, 'expected one or more properties')
-        if not text:
-            if optional:
-                return
-            self.error('expected one or more properties')
-        if text[0] == '(':
-            self.pos += 1
-            text = text[1:]
-            count = 0
-            while True:
-                if not self.parse_property():
-                    if count == 0:
-                        self.error('at least one property expected')
+    def parse_string_datum(self, _datatype):
+        if self.lexer.peek() != '"':
+            self.error('expected string')
+        return self.parse_string()
+
+
+    def parse_reference_datum(self, _datatype):
+        value = self.parse_value(Reference)
+        if value is None:
+            self.error('expected reference')
+        if not value.isnull:
+            self.oddl.references.append((self.current, value))
+        return value
+
+
+    def parse_datatype_datum(self, _datatype):
+        value = self.parse_value(DataType)
+        if value is None:
+            self.error('expected data-type')
+        return value
+
+
+    def parse_base64_datum(self, _datatype):
+        value = self.parse_base64()
+        if value is None:
+            self.error('expected base-64-data')
+        return value
+
+
+    def parse_derived_structure_content(self):
+        # name? ("(" (property ("," property)*)? ")")? "{" structure* "}"
+        self.parse_name()
+        self.advance(False, 'expected derived structure content')
+        self.parse_property_list()
+        self.expect('{')
+        self.current._body_start = self.lexer.pos - self.starts[-1]
+        if self.lazy:
+            self.skip_body()
+            return False
+        return True # the body is parsed by parse_body()
+
+
+    def parse_body(self):
+        # structure* "}"
+        # Structures opened within the body are closed here too
+        depth = len(self.stack)
+        lexer = self.lexer
+        while self.advance(False, 'expected structure or \'}\''):
+            if lexer.accept('}'):
+                if len(self.stack) == depth:
                     break
-                count += 1
-        elif not optional:
-            self.error('expected \'(\' to begin property list')
+                self.close_structure()
+            else:
+                self.open_structure()
+
+
+    def skip_body(self):
+        # Skips to just past the body's closing brace and records where the
+        # body starts so that it can be parsed on demand
+        lexer = self.lexer
+        start = lexer.pos
+        lexer.pos -= 1 # back to the body's opening brace
+        if not lexer.skip_structure():
+            self.error('expected \'}\' at end of structure', start)
+        self.current.body = (self.oddl, lexer.text, start)
+
+
+    def parse_lazy_body(self, structure, text, pos):
+        self.lexer = self.new_lexer(text)
+        self.lexer.pos = pos
+        self.stack = [structure]
+        self.starts = [structure.source_span()[0]]
+        self.parse_body()
+
+
+    def parse_name(self):
+        # Names the current structure and adds it to the global names or to
+        # its parent's local names
+        self.advance(True, 'expected name')
+        token = self.lexer.match('name', NAME_RX)
+        if token is not None:
+            structure = self.current
+            structure._name = name = self.lexer.value(token)
+            names = (self.oddl.global_names if name.startswith('$') else
+                     structure.parent.local_names)
+            if name in names:
+                self.error(f'duplicate name {name}', token.start)
+            names[name] = structure
+
+
+    def parse_property_list(self):
+        # "(" (property ("," property)*)? ")"
+        if not self.lexer.accept('('):
+            return
+        self.advance(False, 'expected property or \')\'')
+        if self.lexer.accept(')'):
+            return
+        while True:
+            self.parse_property()
+            self.advance(False, 'expected \',\' or \')\'')
+            if self.lexer.accept(')'):
+                break
+            self.expect(',')
 
 
     def parse_property(self):
-        text = self.advance(False, 'property expected')
-        if text.startswith(')'):
-            self.pos += 1
-            return False # no more
-        match = ID_RX.match(text)
-        if match is None:
+        # property ::= identifier ("=" property-value)?
+        self.advance(False, 'property expected')
+        token = self.lexer.match('identifier', ID_RX)
+        if token is None:
             self.error('property expected')
-        name = match[0]
-        self.pos += len(name)
-        text = text[len(name):]
-        self.current.properties[name] = True # assume bool
-        while text:
-            c = text[0]
-            self.pos += 1
-            text = text[1:]
-            if c.isspace():
-                continue
-            elif c == ')':
-                return False # no more
-            elif c == ',':
-                break # just had a bool property; another to follow
-            elif c == '=':
-                text = self.advance(False,
-                                    'property value expected')
-                self.parse_property_value(name)
-                break
-            else:
-                self.error('property value expected')
-        return True # maybe more
+        name = sys.intern(self.lexer.value(token))
+        self.advance(False, 'expected \',\' or \')\'')
+        if self.lexer.accept('='):
+            self.advance(False, 'property value expected')
+            value = self.parse_property_value(name)
+        else:
+            value = True # a bool property without a value is true
+        dict.__setitem__(self.current.properties, name, value)
 
 
     def parse_property_value(self, name):
         # (bool-literal | integer-literal | float-literal | string-literal |
         # reference | data-type | base64-data)
-        text = self.text[self.pos:]
-        original = text[:20]
-        value = None
-        if text.startswith('"'):
-            value = self.parse_string()
-        elif text.startswith(('$', '%')):
+        lexer = self.lexer
+        c = lexer.peek()
+        if c == '"':
+            return self.parse_string()
+        if c in {'$', '%'} or lexer.startswith('null'):
             value = self.parse_value(Reference)
             if value is None:
                 self.error('invalid reference')
-        elif text.startswith('false'):
-            value = False
-            self.pos += len('false')
-        elif text.startswith('true'):
-            value = True
-            self.pos += len('true')
-        else:
-            value = self.parse_value(DataType)
-            if value is None:
-                value = self.parse_value(Base64Data)
-                if value is None:
-                    value = self.parse_number()
+            if not value.isnull:
+                self.oddl.references.append((self.current, value))
+            return value
+        token = lexer.match('bool', BOOL_RX)
+        if token is not None:
+            return lexer.value(token) == 'true'
+        value = self.parse_value(DataType)
+        if value is not None:
+            return value
+        start = lexer.pos
+        value = self.parse_number()
+        if value is not None and lexer.scan(PROPERTY_END_RX):
+            return value
+        lexer.pos = start # not a number so may be base-64-data
+        value = self.parse_base64()
         if value is None:
+            original = lexer.slice(start, start + 20)
             self.error(f'invalid property {name} value: {original!r}...')
-        self.current.properties[name] = value
+        return value
 
 
     def parse_string(self):
-        assert self.text[self.pos] == '"', 'expected \'"\' to start string'
-        chars = []
-        prev = ''
-        self.pos += 1 # skip opening "
-        text = self.text[self.pos:]
-        while text:
-            c = text[0]
-            self.pos += 1
-            text = text[1:]
-            if c == '"':
-                if prev == '\\':
-                    prev = ''
-                else: # end of string
-                    return String(''.join(chars))
-            elif c == '\\':
-                if prev == '\\':
-                    prev = ''
-                else:
-                    prev = c
-                    continue
-            elif prev == '\\':
-                prev = ''
-                if c in '\'?abfnrtv':
-                    c = CHAR_FOR_LITERAL[c]
-                elif c in 'xuU':
-                    n = '2' if c == 'x' else ('4' if c == 'u' else '6')
-                    match = re.match(HEX_PATTERN + '{' + n + '}')
-                    if match is not None:
-                        h = match[0]
-                        self.pos += len(h)
-                        text = text[len(h):]
-                        c = chr(int(h, 16))
-                    else:
-                        self.error(
-                            f'expected {n} hex digits not {text[:n]!r}')
-                else:
-                    self.warning(f'needlessly escaped \'{c}\'')
-            chars.append(c)
-        self.error('expected \'"\' at end of string')
+        # string-literal+ (adjacent string-literals are concatenated)
+        lexer = self.lexer
+        parts = []
+        while lexer.peek() == '"':
+            token = lexer.match('string', STRING_RX)
+            if token is None:
+                self.error('expected \'"\' at end of string')
+            parts.append(self.unescape(
+                self.string(token.start + 1, token.end - 1), token.start))
+            self.advance(True, 'expected string')
+        return String(''.join(parts))
+
+
+    def unescape(self, text, pos):
+        if '\\' not in text:
+            return text
+
+        def replace(match):
+            escape = match[1]
+            c = CHAR_FOR_LITERAL.get(escape)
+            if c is not None:
+                return c
+            if len(escape) > 1:
+                return chr(int(escape[1:], 16))
+            if escape in 'xuU':
+                self.error(f'expected hex digits after \\{escape}', pos)
+            self.warning(f'needlessly escaped \'{escape}\'', pos)
+            return escape
+        return ESCAPE_RX.sub(replace, text)
+
+
+    def string(self, start, end):
+        try:
+            return self.lexer.string(start, end)
+        except UnicodeDecodeError as err:
+            self.error(f'invalid UTF-8: {err.reason}', start + err.start)
 
 
     def parse_value(self, Class):
-        match = Class.REGEX.match(self.text[self.pos:])
-        if match is not None:
-            value = match[0]
-            self.pos += len(value)
-            return Class(value)
+        token = self.lexer.match(Class.__name__, Class.REGEX)
+        if token is not None:
+            return Class(self.lexer.value(token))
 
 
-    def parse_number(self):
-        text = self.text[self.pos:]
-        if text.startswith("'"): # char-literal
-            return self.parse_char_literal_as_number(text)
-        match = NUMBER_RX.match(self.text[self.pos:])
-        if match is not None:
-            value = match[0]
-            self.pos += len(value)
-            if len(value) > 2 and value[1] in 'bBoOxX':
-                kind = value[1]
-                radix = 2 if kind in 'bB' else (8 if kind in 'oO' else 16)
-                return int(value[2:], radix)
-            return Real(value) if '.' in value else Int(value)
-
-
-    def parse_char_literal_as_number(self, text):
-        assert text.startswith("'"), 'expected char-literal'
-        j = text.find("'", 1)
-        if j == -1:
-            self.error('expected closing "\'" for char-literal')
-        c = text[1:j] # ignore enclosing 's
-        self.pos += j + 1 # skip past closing '
-        if len(c) == 4 and c.startswith('\\x'):
-            match = re.match(HEX_PATTERN + '{2}', c[2:])
-            if match is not None:
-                return int(match[0], 16)
-            self.error(f'invalid hex char: {c!r}')
-        if len(c) == 2 and c[0] == '\\':
-            c = CHAR_FOR_LITERAL.get(c[1], c[1])
-        if c is not None and len(c) == 1:
-            return Int(ord(c))
-        self.error('invalid char-literal')
+    def parse_base64(self):
+        # Only the text is kept: it is decoded if and when it is accessed
+        token = self.lexer.match('Base64Data', Base64Data.REGEX)
+        if token is not None:
+            try:
+                return Base64Data.fromtext(self.lexer.value(token))
+            except Error as err:
+                self.error(str(err))
+
+
+    def parse_number(self, datatype=None):
+        lexer = self.lexer
+        token = lexer.match('char', CHAR_RX)
+        if token is not None: # char-literal
+            return self.parse_char_literal_as_number(token)
+        token = lexer.match('number', NUMBER_RX)
+        if token is not None:
+            value = lexer.value(token)
+            digits = value.lstrip('+-')
+            if digits[:2] in RADIX_PREFIXES:
+                value = int(value, 0)
+                if datatype in FLOAT_TYPES: # bit pattern of a float
+                    return self.float_for_bits(value, datatype)
+                return Int(value)
+            if '.' in digits or 'e' in digits or 'E' in digits:
+                return Real(value)
+            return Int(value)
+
+
+    def float_for_bits(self, value, datatype):
+        sign = -1 if value < 0 else 1
+        bits_format, float_format = FLOAT_FORMATS[datatype]
+        try:
+            data = struct.pack(bits_format, abs(value))
+        except struct.error:
+            self.error(f'hex value too large for {datatype}')
+        return Real(sign * struct.unpack(float_format, data)[0])
+
+
+    def parse_char_literal_as_number(self, token):
+        text = self.unescape(self.string(token.start + 1, token.end - 1),
+                             token.start)
+        try:
+            return Int(int.from_bytes(text.encode('latin-1'), 'big'))
+        except UnicodeEncodeError:
+            self.error('invalid char-literal')
 
 
     def expect(self, what):
         self.skip_ws_and_comments()
-        text = self.text[self.pos:]
-        if not text or not text.startswith(what):
+        if not self.lexer.accept(what):
             self.error(f'expected {what!r}')
-        self.pos += len(what)
-        return self.text[self.pos:]
 
 
     def advance(self, optional, message):
         self.skip_ws_and_comments()
-        text = self.text[self.pos:]
-        if not text and not optional:
-            self.error(message)
-        return text
+        if self.lexer.at_end:
+            if not optional:
+                self.error(message)
+            return False
+        return True
 
 
     def skip_ws_and_comments(self):
-        text = self.text[self.pos:]
-        match = WS_RX.match(text)
-        if match is not None:
-            ws = match[0]
-            self.lino += ws.count('\n')
-            self.pos += len(ws)
-            text = self.text[self.pos:]
-        if text.startswith('//'):
-            i = self.text.find('\n', self.pos)
-            if i == -1:
-                self.pos = len(self.text)
-                self.warning('comment but no newline at the end')
-                return
-            self.lino += 1
-            self.pos = i + 1
-            self.skip_ws_and_comments() # for the next line...
-        elif text.startswith('/*'):
-            i = self.text.find('*/', self.pos)
-            self.lino += self.text.count('\n', self.pos, i)
-            self.pos = i + 1
-            self.skip_ws_and_comments() # for the next line...
-
-
-    def error(self, message):
-        self.oddl.write(sys.stdout) # TODO delete
-        file = f' {self.oddl.filename!r}' if self.oddl.filename else ''
-        raise Error(
-            f'ERROR:{file} [{self.lino}.{self.column}]: {message!r}')
+        self.lexer.skip_ws_and_comments()
+        if self.lexer.startswith('/*'):
+            self.error('unterminated comment')
 
 
-    def warning(self, message):
-        file = f' {self.oddl.filename!r}' if self.oddl.filename else ''
-        print(f'Warning:{file} [{self.lino}.{self.column}]: {message!r}',
+    def error(self, message, pos=None):
+        raise Error(f'ERROR:{self.location(pos)}: {message!r}')
+
+
+    def warning(self, message, pos=None):
+        print(f'Warning:{self.location(pos)}: {message!r}',
               file=sys.stderr)
 
 
+    def location(self, pos=None):
+        file = f' {self.oddl.filename!r}' if self.oddl.filename else ''
+        lino, column = self.lexer.location(pos)
+        return f'{file} [{lino}.{column}]'
+
+
+class Stats:
+
+    # Statistics gathered by loads() with stats=Stats(); each load adds to
+    # them. times holds the seconds spent in each of TIME_CATEGORIES
+    # ('tree' is everything else, i.e., building the structures); tokens
+    # counts the tokens by kind; datatypes counts the structures by
+    # datatype. on_start(structure, depth) is called as soon as a
+    # structure's datatype is known and on_end(structure, depth) when it
+    # has been parsed.
+
+    def __init__(self, *, on_start=None, on_end=None):
+        self.on_start = on_start
+        self.on_end = on_end
+        self.clear()
+
+
+    def clear(self):
+        self.times = dict.fromkeys(TIME_CATEGORIES, 0.0)
+        self.tokens = collections.Counter()
+        self.datatypes = collections.Counter()
+        self.max_depth = 0
+        self.size = 0 # of the text parsed in characters (bytes if mapped)
+        self.seconds = 0.0
+
+
     @property
-    def column(self):
-        if self.lino == 1:
-            j = -1
-        else:
-            i = j = self.text.find('\n')
-            while True:
-                i = self.text.find('\n', i + 1)
-                if i == -1 or i > self.pos:
-                    break
-                j = i - 1
-        return self.pos - j
+    def bytes_per_second(self):
+        return self.size / self.seconds if self.seconds else 0.0
+
+
+    def __str__(self):
+        lines = [f'{self.size:,} bytes in {self.seconds:.3f}s '
+                 f'({self.bytes_per_second / 1e6:,.2f} MB/s), '
+                 f'{sum(self.datatypes.values()):,} structures, '
+                 f'max depth {self.max_depth}']
+        for category, secs in self.times.items():
+            lines.append(f'{category:>10}: {secs:.3f}s')
+        for heading, counter in (('tokens', self.tokens),
+                                 ('datatypes', self.datatypes)):
+            lines.append(f'{heading}: ' + ', '.join(
+                f'{key} {count:,}' for key, count in counter.most_common()))
+        return '\n'.join(lines)
+
+
+class CountingLexer:
+
+    # Mixin that counts tokens by kind (punctuation by its text)
+
+    def match(self, kind, regex):
+        token = super().match(kind, regex)
+        if token is not None:
+            self.tokens[kind] += 1
+        return token
+
+
+    def accept(self, what):
+        if super().accept(what):
+            self.tokens[what] += 1
+            return True
+        return False
+
+
+class StatsLexer(CountingLexer, Lexer):
+    pass
+
+
+class StatsBytesLexer(CountingLexer, BytesLexer):
+    pass
+
+
+def timed(category, method):
+    # Wraps a Parser method so that its time (less the time of any timed
+    # method it calls) is added to the category
+    def time_method(self, *args):
+        self.enter(category)
+        try:
+            return method(self, *args)
+        finally:
+            self.leave()
+    return time_method
+
+
+class StatsParser(Parser):
+
+    # An instrumented Parser (so the uninstrumented one pays no cost)
+
+    def __init__(self, oddl, stats):
+        super().__init__(oddl)
+        self.stats = stats
+        self.category = 'tree'
+        self.categories = []
+        self.mark = time.perf_counter()
+
+
+    def new_lexer(self, text, lino=1, column=1):
+        Class = StatsLexer if isinstance(text, str) else StatsBytesLexer
+        lexer = Class(text, lino, column)
+        lexer.tokens = self.stats.tokens
+        return lexer
+
+
+    def enter(self, category):
+        now = time.perf_counter()
+        self.stats.times[self.category] += now - self.mark
+        self.mark = now
+        self.categories.append(self.category)
+        self.category = category
+
+
+    def leave(self):
+        now = time.perf_counter()
+        self.stats.times[self.category] += now - self.mark
+        self.mark = now
+        self.category = self.categories.pop()
+
+
+    def parse(self, text):
+        stats = self.stats
+        start = self.mark = time.perf_counter()
+        try:
+            super().parse(text)
+        finally:
+            now = time.perf_counter()
+            stats.times[self.category] += now - self.mark
+            stats.seconds += now - start
+            stats.size += len(text)
+
+
+    def iterparse(self, file, chunksize):
+        # Like parse() but the size is of all the text read
+        stats = self.stats
+        start = self.mark = time.perf_counter()
+        try:
+            yield from super().iterparse(file, chunksize)
+        finally:
+            now = time.perf_counter()
+            stats.times[self.category] += now - self.mark
+            stats.seconds += now - start
+            stats.size += self.lexer.offset + len(self.lexer.text)
+
+
+    def parse_primitive_structure_content(self):
+        self.start_structure()
+        return super().parse_primitive_structure_content()
+
+
+    def parse_derived_structure_content(self):
+        self.start_structure()
+        return super().parse_derived_structure_content()
+
+
+    def close_structure(self):
+        self.end_structure()
+        super().close_structure()
+
+
+    def start_structure(self):
+        stats = self.stats
+        structure = self.current
+        depth = len(self.stack) - 2 # top-level structures are at 0
+        stats.datatypes[structure.datatype] += 1
+        if depth > stats.max_depth:
+            stats.max_depth = depth
+        if stats.on_start is not None:
+            stats.on_start(structure, depth)
+
+
+    def end_structure(self):
+        if self.stats.on_end is not None:
+            self.stats.on_end(self.current, len(self.stack) - 2)
+
+
+    def parse_bulk_data(self, regexes):
+        if super().parse_bulk_data(regexes):
+            self.stats.tokens['number'] += len(self.current.data)
+            return True
+        return False
+
+
+    skip_ws_and_comments = timed('whitespace', Parser.skip_ws_and_comments)
+    parse_bulk_data = timed('number', parse_bulk_data)
+    parse_number = timed('number', Parser.parse_number)
+    parse_string = timed('string', Parser.parse_string)
+    parse_property_list = timed('property', Parser.parse_property_list)
 
 
 class Error(Exception):
     pass
 
 
+def format_floats(data, datatype):
+    # Formats in bulk with the fewest digits that usually round-trip and
+    # only fixes up the values that don't (or aren't finite)
+    digits, _ = FLOAT_DIGITS[datatype]
+    texts = list(map(f'%.{digits}g'.__mod__, data))
+    typecode = TYPECODE_FOR_DATATYPE[datatype]
+    data = array.array(typecode, data)
+    values = array.array(typecode, map(float, texts))
+    if values != data or 'n' in ''.join(texts): # inf or nan
+        for i, (value, original) in enumerate(zip(values, data)):
+            if value != original or 'n' in texts[i]:
+                texts[i] = format_float(original, datatype)
+    return texts
+
+
+def format_float(value, datatype):
+    if not math.isfinite(value): # only expressible as a bit pattern
+        bits_format, float_format = FLOAT_FORMATS[datatype]
+        bits = struct.unpack(bits_format, struct.pack(float_format, value))
+        return f'0x{bits[0]:X}'
+    digits, most = FLOAT_DIGITS[datatype]
+    text = f'{value:.{digits}g}'
+    typecode = TYPECODE_FOR_DATATYPE[datatype]
+    if struct.pack(typecode, float(text)) != struct.pack(typecode, value):
+        text = f'{value:.{most}g}'
+    return text
+
+
+def new_hasher(kind):
+    return hashlib.blake2b(kind, digest_size=DIGEST_SIZE)
+
+
+def hash_int(hasher, value):
+    hasher.update(value.to_bytes(8, 'little', signed=True))
+
+
+def hash_text(hasher, text):
+    data = text.encode('utf-8')
+    hash_int(hasher, len(data))
+    hasher.update(data)
+
+
+def hash_value(hasher, value):
+    # Each value is tagged with its type so that, e.g., 1, 1.0, "1", and
+    # true all have different hashes
+    if value is True or value is False:
+        hasher.update(b'T' if value else b'F')
+    elif isinstance(value, Base64Data):
+        hasher.update(b'z')
+        hash_int(hasher, len(value))
+        hasher.update(value.data)
+    elif isinstance(value, str):
+        hasher.update(b'r' if isinstance(value, Reference) else
+                      b't' if isinstance(value, DataType) else b's')
+        hash_text(hasher, value)
+    elif isinstance(value, int):
+        hasher.update(b'i')
+        hash_text(hasher, str(value))
+    elif isinstance(value, float):
+        hasher.update(b'f')
+        hasher.update(struct.pack('<d', value))
+    else:
+        hasher.update(b'?')
+        hash_text(hasher, repr(value))
+
+
+Difference = collections.namedtuple('Difference', 'kind old new')
+
+
+def diff_structures(old, new):
+    # Returns the Differences between the old and new Oddls (or derived
+    # structures) in document order: ('removed', structure, None), ('added',
+    # None, structure), or ('changed', old, new) for a primitive structure
+    # whose data (or anything else) changed or a derived structure whose
+    # properties changed (its descendants are compared too). Children are
+    # aligned by their digests and subtrees with equal digests are skipped
+    # without being walked, so once the digests are cached the cost
+    # depends on the size of the changes rather than of the trees.
+    differences = []
+    stack = [(old.children, new.children)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Difference):
+            differences.append(item)
+            continue
+        olds, news = item
+        items = []
+        matcher = difflib.SequenceMatcher(
+            None, [structure.digest() for structure in olds],
+            [structure.digest() for structure in news], autojunk=False)
+        for tag, i, end, j, new_end in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            # Pair structures with the same data-type and name in order
+            unpaired = {}
+            for structure in news[j:new_end]:
+                unpaired.setdefault((structure.datatype, structure.name),
+                                    []).append(structure)
+            for structure in olds[i:end]:
+                partners = unpaired.get((structure.datatype, structure.name))
+                if not partners:
+                    items.append(Difference('removed', structure, None))
+                    continue
+                partner = partners.pop(0)
+                if (isinstance(structure, DerivedStructure) and
+                        isinstance(partner, DerivedStructure)):
+                    if ((structure._properties or {}) !=
+                            (partner._properties or {})):
+                        items.append(Difference('changed', structure,
+                                                partner))
+                    items.append((structure.children, partner.children))
+                else:
+                    items.append(Difference('changed', structure, partner))
+            for partners in unpaired.values():
+                items += (Difference('added', None, structure)
+                          for structure in partners)
+        stack.extend(reversed(items))
+    return differences
+
+
+def numpy_module():
+    # NumPy is optional so is only required when it is used
+    if numpy is None:
+        raise Error('NumPy is required but is not installed')
+    return numpy
+
+
+def compression_for(filename, mode='r'):
+    # Returns the module (gzip, bz2, or lzma) needed to read the file
+    # (going by its magic bytes) or to write it (going by its extension),
+    # or None if it isn't compressed
+    if 'r' in mode:
+        try:
+            with open(filename, 'rb') as file:
+                return compression_for_magic(file.read(MAGIC_SIZE))
+        except OSError:
+            return None # so that opening it reports the error
+    return COMPRESSION_FOR_SUFFIX.get(os.path.splitext(filename)[1].lower())
+
+
+def compression_for_magic(data):
+    for magic, compression in COMPRESSION_FOR_MAGIC.items():
+        if data.startswith(magic):
+            return compression
+    return None
+
+
+def open_file(filename, mode='rt'):
+    # Like open() (using UTF-8 for text) except that a compressed file
+    # (see compression_for()) is decompressed as it is read, or compressed
+    # as it is written
+    encoding = None if 'b' in mode else 'utf-8'
+    compression = compression_for(filename, mode)
+    if compression is None:
+        return open(filename, mode, encoding=encoding)
+    if compression is gzip and 'r' not in mode:
+        return gzip.open(filename, mode, compresslevel=GZIP_LEVEL,
+                         encoding=encoding)
+    return compression.open(filename, mode, encoding=encoding)
+
+
+def copy_range(source, out, start, end):
+    # Copies the source file's bytes from start to end to the output file,
+    # using sendfile (i.e., without reading them into Python) if possible
+    if hasattr(os, 'sendfile'):
+        out.flush()
+        while start < end:
+            try:
+                count = os.sendfile(out.fileno(), source.fileno(), start,
+                                    end - start)
+            except OSError:
+                break # not supported for these files so do a buffer copy
+            if not count:
+                return
+            start += count
+    source.seek(start)
+    while start < end:
+        data = source.read(min(end - start, CHUNK_SIZE))
+        if not data:
+            return
+        out.write(data)
+        start += len(data)
+
+
+def same(a, b):
+    # Property values are equal and both or neither bool (so 1 != true)
+    return a == b and isinstance(a, bool) == isinstance(b, bool)
+
+
+def valid_int(value, datatype):
+    low, high = INT_RANGE[datatype]
+    return (isinstance(value, int) and not isinstance(value, bool) and
+            low <= value <= high)
+
+
+def valid_float(value, _datatype):
+    return isinstance(value, (float, int)) and not isinstance(value, bool)
+
+
+def valid_f16(value, datatype):
+    return valid_float(value, datatype) and (abs(value) <= F16_MAX or
+                                             math.isinf(value))
+
+
+def valid_bool(value, _datatype):
+    return isinstance(value, bool)
+
+
+def valid_str(value, _datatype):
+    return isinstance(value, str)
+
+
+def valid_reference(value, _datatype):
+    return (isinstance(value, str) and
+            Reference.REGEX.fullmatch(value) is not None)
+
+
+def valid_datatype(value, _datatype):
+    return (isinstance(value, str) and
+            DataType.REGEX.fullmatch(value) is not None)
+
+
+def valid_base64(value, _datatype):
+    return isinstance(value, Base64Data)
+
+
+def aligned(offset, alignment=8):
+    return (offset + alignment - 1) & ~(alignment - 1)
+
+
+def async_semaphore():
+    # The running loop's semaphore that limits use of the executors
+    loop = asyncio.get_running_loop()
+    semaphore = SEMAPHORE_FOR_LOOP.get(loop)
+    if semaphore is None:
+        semaphore = SEMAPHORE_FOR_LOOP[loop] = asyncio.Semaphore(ASYNC_LIMIT)
+    return semaphore
+
+
+def io_executor_for(executor):
+    # File objects and trees can't be sent to other processes so I/O uses
+    # the loop's default executor in place of a process pool
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        return None
+    return executor
+
+
+def parse_text(filename, text, compression=None):
+    # Parses the text (or UTF-8 bytes, compressed if compression is given)
+    # in an executor and returns an Oddl
+    oddl = Oddl()
+    oddl.filename = filename
+    if compression is not None:
+        try:
+            text = compression.decompress(text)
+        except DECOMPRESSION_ERRORS as err:
+            raise Error(f'ERROR: {filename!r}: invalid compressed data: '
+                        f'{err}') from err
+    oddl.loads(text)
+    oddl.source = None
+    return flatten(oddl)
+
+
+def parse_piece(filename, text, lino, column):
+    # Parses part of a file (starting at the given line and column) in a
+    # worker process and returns a flattened Oddl of its structures
+    oddl = Oddl()
+    oddl.filename = filename
+    parser = Parser(oddl)
+    parser.lexer = parser.new_lexer(text, lino, column)
+    while parser.advance(True, 'structure expected'):
+        parser.parse_structure()
+    return flatten(oddl)
+
+
+def parse_mapped_piece(filename, start, end):
+    # Parses the structures between the given offsets of an mmap of the
+    # file in a worker process and returns a flattened Oddl of them
+    oddl = Oddl()
+    oddl.filename = filename
+    parser = Parser(oddl)
+    with open(filename, 'rb') as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ) as text:
+        lexer = parser.lexer = parser.new_lexer(text)
+        lexer.pos = start
+        while lexer.pos < end and parser.advance(True,
+                                                 'structure expected'):
+            parser.parse_structure()
+    return flatten(oddl)
+
+
+def flatten(oddl):
+    # Unlinks the Oddl's tree so that it can be pickled (e.g., to return
+    # it from a worker process) without recursion however deep it is;
+    # returns the Oddl, its structures in document order, and how many
+    # children it and each of them has for unflatten()
+    structures = []
+    counts = [len(oddl.structures)]
+    stack = list(reversed(oddl.structures))
+    while stack:
+        structure = stack.pop()
+        structure.parent = None
+        structures.append(structure)
+        children = getattr(structure, '_structures', None)
+        counts.append(len(children) if children else 0)
+        if children:
+            stack += reversed(children)
+            list.clear(children)
+    list.clear(oddl.structures)
+    return oddl, structures, counts
+
+
+def unflatten(flat):
+    # Returns the Oddl flatten() was given with its tree relinked
+    oddl, structures, counts = flat
+    counts = iter(counts)
+    stack = [[oddl, next(counts)]] # parent and children yet to add
+    for structure, count in zip(structures, counts):
+        while not stack[-1][1]:
+            stack.pop()
+        parent = stack[-1][0]
+        stack[-1][1] -= 1
+        structure.parent = parent
+        list.append(parent._structures, structure)
+        if count:
+            stack.append([structure, count])
+    return oddl
+
+
+def lint_file(filename, cache=True):
+    # Checks the file (see Oddl.check()) and returns (ok, messages) where
+    # messages include any warnings. If cache is True (or a directory)
+    # results are kept in a LintCache so that files that haven't changed
+    # since this version of the library checked them aren't parsed again.
+    if cache:
+        cache = LintCache(None if cache is True else cache)
+        key = cache.key(filename)
+        result = cache.get(key)
+        if result is not None:
+            return result
+    out = io.StringIO()
+    with contextlib.redirect_stderr(out):
+        oddl = Oddl()
+        oddl.filename = filename
+        try:
+            oddl.load()
+            problems = oddl.check()
+        except (Error, UnicodeDecodeError) as err:
+            print(err, file=out)
+            problems = None
+    messages = out.getvalue().splitlines()
+    ok = problems == []
+    if problems:
+        messages += problems
+    if cache and cache.directory:
+        cache.put(key, ok, messages)
+    return ok, messages
+
+
+def lint_cache_directory():
+    # $ODDL_LINT_CACHE if set (an empty value means don't cache) else the
+    # user's cache directory
+    directory = os.environ.get('ODDL_LINT_CACHE')
+    if directory is None:
+        directory = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'), 'oddl')
+    return directory
+
+
+def process(action, filename):
+    # Checks, formats, or reports the duplicates in the file and returns
+    # (filename, size, messages, ok) rather than printing, so that it can
+    # run in a worker process
+    out = io.StringIO()
+    ok = True
+    size = 0
+    with contextlib.redirect_stderr(out):
+        try:
+            size = os.path.getsize(filename)
+            if action == 'lint':
+                ok, messages = lint_file(filename)
+                return filename, size, messages, ok
+            oddl = Oddl(filename)
+            if action == 'dedup':
+                report_duplicates(oddl, out)
+            else:
+                oddl.save()
+        except (Error, OSError) as err:
+            print(err, file=out)
+            ok = False
+    return filename, size, out.getvalue().splitlines(), ok
+
+
+def report_duplicates(oddl, out):
+    # Groups with the most source text duplicated come first
+    groups = oddl.duplicates()
+    groups.sort(key=lambda group: (len(group) - 1) * (group[0].size or 0),
+                reverse=True)
+    for group in groups:
+        structure = group[0]
+        size = f' ({structure.size:,} chars)' if structure.size else ''
+        print(f'{len(group)} identical {structure.datatype}{size}:',
+              file=out)
+        for structure in group:
+            print(f'    {structure.path()}', file=out)
+
+
+def report_differences(differences, out):
+    for kind, old, new in differences:
+        if kind == 'changed':
+            path = old.path()
+            if new.path() != path:
+                path += f' -> {new.path()}'
+        else:
+            path = (old or new).path()
+        print(f'{DIFF_SYMBOL[kind]} {path}', file=out)
+
+
 RESERVED_STRUCTURE_ID_RX = re.compile(r'[a-z][0-9]*')
 ID_RX = re.compile(r'[A-Za-z_][0-9A-Za-z_]*')
 NAME_RX = re.compile(r'[%$][A-Za-z_][0-9A-Za-z_]*')
-WS_RX = re.compile(r'[\s\n]+', re.DOTALL | re.MULTILINE)
-HEX_PATTERN = '[A-Fa-z[0-9]]'
+SPACE_RX = re.compile(r'\s+')
+WS_RX = re.compile(r'(?:\s+|//[^\n]*|/\*.*?\*/)+', re.DOTALL)
+REFERENCE_PART_RX = re.compile(r'[%$][A-Za-z_][0-9A-Za-z_]*')
+NEWLINE_RX = re.compile('\n')
+BOOL_RX = re.compile(r'(?:true|false)(?![0-9A-Za-z_])')
+STRING_RX = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+CHAR_RX = re.compile(r"'(?:[^'\\]|\\.)+'")
+ESCAPE_RX = re.compile(
+    r'\\(x[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{6}|.)', re.DOTALL)
+SCAN_RX = re.compile( # innermost {...} (and what follows) is one match
+    r'(\{[^{}"\'/]*\})[^{}"\'/=bz]*|[^{}"\'/=bz]+|(\{)|(\})|([=bz])|'
+    r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|'
+    r'//[^\n]*\n|/\*.*?\*/|/(?![/*])', re.DOTALL)
+PROPERTY_END_RX = re.compile(r'\s|//|/\*|[,)\]]|$') # ] for queries
 NUMBER_RX = re.compile( # does _not_ handle char-literal's
     r'[-+]?(?:' # order: letters first then longest to shortest
     r'0[bB][01](?:_?[01])*|' # binary-literal
     r'0[oO][0-7](?:_?[0-7])*|' # octal-literal
     r'0[xX][A-Fa-f0-9](?:_?[A-Fa-f0-9])*|' # hex-literal / float-literal
-    r'(?:[0-9](?:_?[0-9])*(?:\.[0-9](?:_?[0-9])*)?|\.[0-9](?:_?[0-9])*)'
-    r'(?:(?:[eE][-+]?[0-9])?(:?_?[0-9])*)?|' # optional exponent
-    r'[0-9](?:_?[0-9])*' # decimal-literal
+    r'(?:[0-9](?:_?[0-9])*(?:\.(?:[0-9](?:_?[0-9])*)?)?|' # decimal or
+    r'\.[0-9](?:_?[0-9])*)' # float-literal
+    r'(?:[eE][-+]?[0-9](?:_?[0-9])*)?' # optional exponent
     r')') # must use [0-9] rather than \d because \d is broader
-CHAR_FOR_LITERAL = {"'": "'", '?': '?', 'a': '\a', 'b': '\b', 'f': '\f',
-                    'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+BASE64_START_RX = re.compile( # maybe base-64-data (see skip_base64)
+    r'(?<![0-9A-Za-z_$%])(?:base64|z)(?![0-9A-Za-z_])|(=)')
+SCAN_WS = r'(?:\s|//[^\n]*(?![^\n])|/\*.*?\*/)*' # without backtracking
+BASE64_HEADER_RX = re.compile(
+    r'(?:base64|z)' + SCAN_WS +
+    r'(?:(\[)' + SCAN_WS + r'[^\]{}"/\s]*' + SCAN_WS + r'\]' + SCAN_WS +
+    r'\*?' + SCAN_WS + r')?(?:[%$][A-Za-z_][0-9A-Za-z_]*' + SCAN_WS +
+    r')?\{', re.DOTALL)
+BASE64_ITEM_RX = re.compile(r'(\{)|(\})|,')
+NOT_BASE64_VALUE_RX = re.compile( # as tried before base-64-data
+    r'["\'$%]|null|' + BOOL_RX.pattern + '|' + DataType.REGEX.pattern +
+    r'|(?:' + NUMBER_RX.pattern + r')(?=' + PROPERTY_END_RX.pattern + ')')
+RADIX_PREFIXES = {'0b', '0B', '0o', '0O', '0x', '0X'}
+CHAR_FOR_LITERAL = {'"': '"', "'": "'", '?': '?', '\\': '\\', 'a': '\a',
+                    'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+                    'v': '\v'}
+INT_RANGE = {'i8': (-0x80, 0x7F), 'i16': (-0x8000, 0x7FFF),
+             'i32': (-0x8000_0000, 0x7FFF_FFFF),
+             'i64': (-0x8000_0000_0000_0000, 0x7FFF_FFFF_FFFF_FFFF),
+             'u8': (0, 0xFF), 'u16': (0, 0xFFFF), 'u32': (0, 0xFFFF_FFFF),
+             'u64': (0, 0xFFFF_FFFF_FFFF_FFFF)}
+INT_TYPES = frozenset(INT_RANGE)
+FLOAT_FORMATS = {'f16': ('<H', '<e'), 'f32': ('<I', '<f'),
+                 'f64': ('<Q', '<d')}
+FLOAT_TYPES = frozenset(FLOAT_FORMATS)
+TYPECODE_FOR_DATATYPE = { # array has no half floats so f16 uses float32
+    'i8': 'b', 'i16': 'h', 'i32': 'i', 'i64': 'q', 'u8': 'B', 'u16': 'H',
+    'u32': 'I', 'u64': 'Q', 'f16': 'f', 'f32': 'f', 'f64': 'd'}
+BULK_INT = r'[-+]?[0-9]+'
+BULK_FLOAT = r'[-+]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+BULK_LIST_RX = {}
+BULK_ARRAY_LIST_RX = {}
+for _datatype in TYPECODE_FOR_DATATYPE:
+    _number = BULK_FLOAT if _datatype in FLOAT_TYPES else BULK_INT
+    _list = rf'\s*{_number}(?:\s*,\s*{_number})*\s*'
+    BULK_LIST_RX[_datatype] = re.compile(rf'(?:{_list})?(?=\}})')
+    BULK_ARRAY_LIST_RX[_datatype] = re.compile(
+        rf'\s*(?:\{{{_list}\}}(?:\s*,\s*\{{{_list}\}})*\s*)?(?=\}})')
+del _datatype, _number, _list
+BULK_ROW_RX = re.compile(r'\{([^}]*)\}')
+NUMPY_THRESHOLD = 1 << 16
 TAB = '    '
+LINE_WIDTH = 76
+WRITE_CHUNK_SIZE = 1 << 18
+FLOAT_DIGITS = {'f16': (7, 9), 'f32': (7, 9), 'f64': (15, 17)} # f16 are
+                                                              # float32s
+EVENTS = frozenset({'start', 'property', 'data', 'end'})
+CHUNK_SIZE = 1 << 20
+BYTES_FOR_RX = {} # bytes versions of the regexes (made on demand)
+DIRTY_WITHIN = 1
+DIRTY = 2
+ASYNC_LIMIT = 4 # see Oddl.aload()
+SEMAPHORE_FOR_LOOP = weakref.WeakKeyDictionary()
+COMPRESSION_FOR_MAGIC = {b'\x1f\x8b': gzip, b'BZh': bz2,
+                         b'\xfd7zXZ\x00': lzma}
+COMPRESSION_FOR_SUFFIX = {'.gz': gzip, '.bz2': bz2, '.xz': lzma}
+MAGIC_SIZE = 6
+GZIP_LEVEL = 6 # gzip's default (gzip.open()'s is 9 which is much slower)
+DECOMPRESSION_ERRORS = (EOFError, OSError, lzma.LZMAError, zlib.error)
+TIME_CATEGORIES = ('whitespace', 'number', 'string', 'property', 'tree')
+F16_MAX = 65504.0
+PROPERTY_TYPES = (bool, Int, Real, String, Reference, DataType, Base64Data)
+VALID_FOR_DATATYPE = { # see PrimitiveStructure.problems()
+    'f16': valid_f16, 'f32': valid_float, 'f64': valid_float,
+    'b': valid_bool, 's': valid_str, 'r': valid_reference,
+    't': valid_datatype, 'z': valid_base64,
+    **dict.fromkeys(INT_TYPES, valid_int)}
+DIGEST_SIZE = 16
+DIFF_SYMBOL = {'added': '+', 'removed': '-', 'changed': '~'}
+DTYPE_FOR_DATATYPE = {
+    'i8': 'int8', 'i16': 'int16', 'i32': 'int32', 'i64': 'int64',
+    'u8': 'uint8', 'u16': 'uint16', 'u32': 'uint32', 'u64': 'uint64',
+    'f16': 'float16', 'f32': 'float32', 'f64': 'float64', 'b': 'bool'}
 
 
 if __name__ == '__main__':
@@ -640,7 +3936,8 @@ if __name__ == '__main__':
     if len(sys.argv) == 1 or sys.argv[1] in {'h', 'help', '-h', '--help'}:
         raise SystemExit(f'''\
 usage: {pathlib.Path(sys.argv[0]).name} \
-[check] <file1.oddl> [<file2.oddl> [... <fileN.oddl>]]
+[check|format|dedup] [-j N] <file1.oddl> [<file2.oddl> [... <fileN.oddl>]]
+ -or-: {pathlib.Path(sys.argv[0]).name} diff <old.oddl> <new.oddl>
  -or-: {pathlib.Path(sys.argv[0]).name} help
 
 h help         : show this usage and quit.
@@ -649,6 +3946,20 @@ l lint c check : check each .oddl file and report any problems (this is the
 f format       : resave each .oddl file reformatted with indentation and
                  newlines to produce a regularized human-readable file (with
                  comments stripped and all numbers in base 10).
+u dedup        : report the groups of primitive structures in each .oddl
+                 file that have identical data (largest first).
+d diff         : report the structures added (+), removed (-), and changed
+                 (~) from the old .oddl file to the new one; the exit code
+                 is 1 if there are any differences.
+j N jobs N     : process the files using N processes (default 1; 0 means
+                 one per CPU); results are still reported in file order.
+
+Check results are cached by content (and library version) in
+$ODDL_LINT_CACHE (default ~/.cache/oddl) so that unchanged files are not
+checked again; set ODDL_LINT_CACHE to an empty string to disable this.
+
+Files compressed with gzip, bzip2, or xz (e.g., .oddl.gz, .oddl.bz2, or
+.oddl.xz) are decompressed (and when formatted, recompressed) on the fly.
 
 Letter options may be prefixed by - and word options by -- e.g., -l or \
 --format.
@@ -660,17 +3971,57 @@ Letter options may be prefixed by - and word options by -- e.g., -l or \
         action = 'lint'
     elif arg in {'f', 'format', '-f', '--format'}:
         action = 'format'
+    elif arg in {'u', 'dedup', '-u', '--dedup'}:
+        action = 'dedup'
+    elif arg in {'d', 'diff', '-d', '--diff'}:
+        if len(args) != 3:
+            raise SystemExit('diff needs an old and a new .oddl file')
+        try:
+            differences = Oddl(args[1]).diff(Oddl(args[2]))
+        except (Error, OSError) as err:
+            raise SystemExit(err)
+        report_differences(differences, sys.stdout)
+        raise SystemExit(1 if differences else 0)
     if action is None:
         action = 'lint'
     else:
         args = args[1:]
-    for filename in args:
-        print('\n' + f' {filename} '.center(72, '@'))
-        try:
-            oddl = Oddl(filename)
-            if action == 'lint':
-                oddl.check()
-            else:
-                oddl.save()
-        except Error as err:
-            print(err)
+    jobs = 1
+    match = re.fullmatch(r'(?:-?j|--jobs|jobs)(?:=?([0-9]+))?',
+                         args[0]) if args else None
+    if match is not None:
+        args = args[1:]
+        value = match[1]
+        if value is None and args:
+            value = args.pop(0)
+        if value is None or not value.isdecimal():
+            raise SystemExit(f'invalid number of jobs: {value!r}')
+        jobs = int(value) or os.cpu_count() or 1
+    start = time.monotonic()
+    size = count = failures = 0
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs)
+        results = executor.map(
+            process, itertools.repeat(action), args,
+            chunksize=max(1, len(args) // (jobs * 8)))
+    else:
+        executor = None
+        results = map(process, itertools.repeat(action), args)
+    try:
+        for filename, filesize, messages, ok in results:
+            print('\n' + f' {filename} '.center(72, '@'))
+            for message in messages:
+                print(message)
+            count += 1
+            size += filesize
+            if not ok:
+                failures += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    secs = max(time.monotonic() - start, 1e-9)
+    print(f'\n{count:,} file{"s" if count != 1 else ""} ({size:,} bytes, '
+          f'{failures:,} with errors) in {secs:.2f}s: {count / secs:,.1f} '
+          f'files/s, {size / secs / 1e6:,.2f} MB/s')
+    if failures:
+        raise SystemExit(1)
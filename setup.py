@@ -33,4 +33,5 @@ setuptools.setup(
     py_modules=['oddl'],
     scripts=['oddl.py'],
     python_requires='>=3.8',
+    extras_require={'numpy': ['numpy']},
 )
@@ -2,10 +2,20 @@
 # Copyright © 2021 Mark Summerfield. All rights reserved.
 # License: GPLv3
 
+import asyncio
+import concurrent.futures
+import io
+import os
+import pathlib
+import sys
+import tempfile
 import unittest
+import unittest.mock
 
 import oddl
 
+EG = pathlib.Path(__file__).parent / 'eg'
+
 
 class TestOddl(unittest.TestCase):
 
@@ -13,5 +23,937 @@ class TestOddl(unittest.TestCase):
         self.maxDiff = None
 
 
+    def test_load_examples(self):
+        for name, count in (('Example.oddl', 1), ('GeometryNode.oddl', 1),
+                            ('GreenCube.oddl', 5)):
+            doc = oddl.Oddl(str(EG / name))
+            self.assertEqual(len(doc.structures), count)
+
+
+    def test_structure_tree(self):
+        doc = oddl.Oddl(str(EG / 'GreenCube.oddl'))
+        metric, _, node, geometry, _ = doc.structures
+        self.assertEqual(metric.datatype, 'Metric')
+        self.assertEqual(metric.properties, {'key': 'distance'})
+        self.assertEqual(metric.structures[0].datatype, 'f32')
+        self.assertAlmostEqual(metric.structures[0].datalist[0], 0.01)
+        self.assertEqual(node.name, '$node1')
+        mesh = geometry.structures[0]
+        self.assertEqual(mesh.properties['primitive'], 'triangles')
+        positions = mesh.structures[0].structures[0]
+        self.assertEqual(positions.dataarraylistsize, 3)
+        self.assertEqual(len(positions.dataarraylist), 24)
+        self.assertEqual(positions.dataarraylist[0].tolist(),
+                         [-50.0, -50.0, 0.0])
+        indexes = mesh.structures[3].structures[0]
+        self.assertEqual(indexes.datatype, 'u32')
+        self.assertEqual(indexes.dataarraylist[-1].tolist(), [22, 23, 20])
+
+
+    def test_literals(self):
+        doc = oddl.Oddl()
+        doc.loads(r'''X (b, c = 0x10, d = "a\tb" "c", e = $x%y,
+                         f = float, g = QUJD, h = -1.5e3)
+        {
+            int8 {'A', -0x7F, 0b11, 0o7, 1_0} // comment
+            float {0x3F800000, 1, .5} /* comment */
+            u8[2]* {s1 {1, 2}, {3, 4}}
+        }''')
+        x = doc.structures[0]
+        self.assertEqual(x.properties, {
+            'b': True, 'c': 16, 'd': 'a\tbc', 'e': '$x%y', 'f': 'f32',
+            'g': b'ABC', 'h': -1500.0})
+        ints, floats, states = x.structures
+        self.assertEqual(ints.datalist.tolist(), [65, -127, 3, 7, 10])
+        self.assertEqual(floats.datalist.tolist(), [1.0, 1.0, 0.5])
+        self.assertEqual([(state, values.tolist())
+                          for state, values in states.dataarraylist],
+                         [('s1', [1, 2]), (None, [3, 4])])
+
+
+    def test_typed_data(self):
+        doc = oddl.Oddl(str(EG / 'GreenCube.oddl'))
+        mesh = doc.structures[3].structures[0]
+        positions = mesh.structures[0].structures[0]
+        self.assertEqual(positions.data.typecode, 'f')
+        self.assertEqual(len(positions.data), 72)
+        view = positions.view
+        self.assertEqual(view.shape, (24, 3))
+        self.assertEqual(view[1, 1], 50.0)
+        self.assertEqual(view.nbytes, 72 * 4)
+        indexes = mesh.structures[3].structures[0]
+        self.assertEqual(indexes.data.typecode, 'I')
+        self.assertEqual(indexes.view.tolist()[0], [0, 1, 2])
+        name = doc.structures[2].structures[0].structures[0]
+        self.assertEqual(name.datalist, ['Cube'])
+        self.assertIsNone(name.view)
+        structure = oddl.PrimitiveStructure(oddl.DataType('int16'))
+        structure.datalist = [1, 2, 3]
+        self.assertEqual(structure.data.typecode, 'h')
+        structure.dataarraylistsize = 2
+        structure.dataarraylist = [[1, 2], [3, 4]]
+        self.assertEqual(structure.view.tolist(), [[1, 2], [3, 4]])
+        with self.assertRaises(oddl.Error):
+            structure.dataarraylist = [[1, 2, 3]]
+
+
+    def test_iterparse(self):
+        filename = str(EG / 'GreenCube.oddl')
+        expected = oddl.Oddl(filename)
+        for chunksize in (1, 10, None):
+            doc = oddl.Oddl()
+            events = [(event, getattr(value, 'datatype', value))
+                      for event, value in doc.iterparse(
+                          filename, chunksize=chunksize)]
+            self.assertEqual(doc.structures, [])
+            self.assertEqual(events[:6], [
+                ('start', 'Metric'), ('property', ('key', 'distance')),
+                ('start', 'f32'), ('data', 'f32'), ('end', 'f32'),
+                ('end', 'Metric')])
+            self.assertEqual(sum(event == 'end' for event, _ in events),
+                             28)
+        doc = oddl.Oddl()
+        ends = [structure.datatype for _, structure in doc.iterparse(
+                filename, events={'end'}, keep=True)]
+        self.assertEqual(ends[-1], 'Material')
+        self.assertEqual([structure.datatype
+                          for structure in doc.structures],
+                         [structure.datatype
+                          for structure in expected.structures])
+
+
+    def test_skip_base64(self):
+        # // and /* inside base-64-data aren't comments
+        text = ('X (p = AB//CA==) {z {AB//CA==}\n'
+                '  z[2]* $a {s1 // {\n{QQ//, /+==}}}\nY {u8 {1 // }\n}}\n')
+        for lexer in (oddl.Lexer(text), oddl.BytesLexer(text.encode())):
+            self.assertTrue(lexer.skip_structure())
+            self.assertEqual(lexer.pos, text.index('\nY'))
+            lexer.pos += 1
+            self.assertTrue(lexer.skip_structure())
+            self.assertEqual(lexer.pos, len(text) - 1)
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'blob.oddl')
+            with open(filename, 'wt', encoding='utf-8') as file:
+                file.write(text + 'Z {}\n' * 1000)
+            doc = oddl.Oddl()
+            for event, structure in doc.iterparse(filename, events={'end'},
+                                                  chunksize=16):
+                if structure.datatype == 'X':
+                    data = structure.structures[0].data
+                    self.assertEqual(bytes(data[0]), b'\x00\x1f\xff\x08')
+                    break
+            else:
+                self.fail('X not yielded')
+
+
+    def test_bulk_data(self):
+        doc = oddl.Oddl()
+        doc.loads('''X {
+            float {1, -2.5, .5e1, 3.}
+            float {1, 0x3F800000} // general path
+            u16[2] {{1, 2}, {+3, 4}}
+            f64[2] {{1, 2}, {3, 4 /* general path */}}
+            i8 {}
+        }''')
+        floats, mixed, ints, doubles, empty = doc.structures[0].structures
+        self.assertEqual(floats.data.tolist(), [1.0, -2.5, 5.0, 3.0])
+        self.assertEqual(mixed.data.tolist(), [1.0, 1.0])
+        self.assertEqual(ints.view.tolist(), [[1, 2], [3, 4]])
+        self.assertEqual(doubles.data, doubles.make_data([1, 2, 3, 4]))
+        self.assertEqual(len(empty.data), 0)
+        with self.assertRaises(oddl.Error):
+            oddl.Oddl().loads('X {u8[2] {{1, 2}, {3}}}')
+
+
+    def test_names(self):
+        doc = oddl.Oddl(str(EG / 'GreenCube.oddl'))
+        self.assertEqual(list(doc.global_names),
+                         ['$node1', '$geometry1', '$material1'])
+        node, geometry = doc.structures[2:4]
+        ref = node.structures[1].structures[0]
+        self.assertIs(doc.resolve(ref.datalist[0]), geometry)
+        self.assertEqual(doc.referrers(geometry), [(ref, '$geometry1')])
+        self.assertEqual(doc.referrers(node), [])
+        self.assertIsNone(doc.resolve('null'))
+        self.assertIsNone(doc.resolve('$missing'))
+        doc = oddl.Oddl(str(EG / 'GeometryNode.oddl'))
+        node = doc.structures[0]
+        translation = node.structures[0]
+        track = node.structures[1].structures[0]
+        self.assertIs(doc.resolve(track.properties['target'], track),
+                      translation)
+        self.assertIsNone(doc.resolve('%xpos'))
+        doc = oddl.Oddl()
+        doc.loads('A $a {B %b {C %c {}}} D {ref {$a%b%c, null}}')
+        c = doc.structures[0].structures[0].structures[0]
+        self.assertIs(doc.resolve('$a%b%c'), c)
+        self.assertIs(c.parent.parent, doc.structures[0])
+        self.assertEqual(len(doc.references), 1)
+        for text in ('A $a {} B $a {}', 'A {B %b {} C %b {}}'):
+            with self.assertRaisesRegex(oddl.Error, 'duplicate name'):
+                oddl.Oddl().loads(text)
+        oddl.Oddl().loads('A {B %b {}} C {D %b {}}')
+        # The name tables follow renames, additions, and removals
+        doc = oddl.Oddl(str(EG / 'GreenCube.oddl'))
+        material = doc.global_names['$material1']
+        material.name = '$material2'
+        self.assertIs(doc.resolve('$material2'), material)
+        self.assertIsNone(doc.resolve('$material1'))
+        with self.assertRaisesRegex(oddl.Error, 'duplicate name'):
+            material.name = '$node1'
+        extra = oddl.DerivedStructure('Extra')
+        extra.name = '$extra'
+        extra.structures.append(oddl.DerivedStructure('Inner'))
+        extra.structures[0].name = '$inner'
+        extra.structures[0].structures.append(oddl.DerivedStructure('Leaf'))
+        extra.structures[0].structures[0].name = '%leaf'
+        doc.structures.append(extra)
+        self.assertIs(doc.resolve('$extra'), extra)
+        self.assertIs(doc.resolve('$inner%leaf'),
+                      extra.structures[0].structures[0])
+        clash = oddl.DerivedStructure('Clash')
+        clash.name = '$extra'
+        with self.assertRaisesRegex(oddl.Error, 'duplicate name'):
+            doc.structures[0].structures.append(clash)
+        self.assertIsNone(clash.parent)
+        material.structures.append(extra.structures.pop()) # moved
+        self.assertIs(doc.resolve('$inner').parent, material)
+        doc.structures.remove(extra)
+        self.assertIsNone(extra.parent)
+        self.assertIsNone(doc.resolve('$extra'))
+        del material.structures[-1]
+        self.assertIsNone(doc.resolve('$inner'))
+        node = doc.global_names['$node1']
+        node.structures[0].name = '%first'
+        self.assertIs(doc.resolve('$node1%first'), node.structures[0])
+        node.structures = []
+        self.assertIsNone(doc.resolve('$node1%first'))
+
+
+    def test_lazy(self):
+        filename = str(EG / 'GreenCube.oddl')
+        expected = oddl.Oddl(filename)
+        doc = oddl.Oddl(filename, lazy=True)
+        self.assertTrue(all(structure.body is not None
+                            for structure in doc.structures))
+        self.assertEqual(doc.structures[0].properties, {'key': 'distance'})
+        geometry = doc.structures[3]
+        self.assertEqual(geometry.name, '$geometry1')
+        mesh = geometry.structures[0]
+        self.assertIsNone(geometry.body)
+        self.assertIsNotNone(mesh.body)
+        self.assertEqual(
+            mesh.structures[0].structures[0].view.tolist(),
+            expected.structures[3].structures[0].structures[0]
+            .structures[0].view.tolist())
+        self.assertIs(doc.resolve('$material1'), doc.structures[4])
+        self.assertEqual(len(doc.referrers(doc.structures[4])), 1)
+        doc.loads('A {}\nB {\n C {u8 {300}}}', lazy=True)
+        with self.assertRaisesRegex(oddl.Error, r'\[3\.12\]'):
+            doc.structures[1].structures[0].structures
+        with self.assertRaises(oddl.Error):
+            doc.loads('A { B {}', lazy=True)
+        doc.loads('X {z {AB//CD==}}\nY {}', lazy=True)
+        self.assertEqual(doc.dumps(), 'X\n{\n    z {AB//CD==}\n}\nY {}\n')
+        import bench
+        text = bench.generate('blob', 300_000)
+        expected.loads(text)
+        doc.loads(text, lazy=True)
+        self.assertEqual(doc.dumps(), expected.dumps())
+
+
+    def test_parallel(self):
+        text = (EG / 'GreenCube.oddl').read_text()
+        text += text.replace('$', '$x')
+        expected = oddl.Oddl()
+        expected.loads(text)
+        doc = oddl.Oddl()
+        doc.loads(text, jobs=2)
+        self.assertEqual(len(doc.structures), 10)
+        for structure, expected_structure in zip(doc.structures,
+                                                 expected.structures):
+            self.assertIs(structure.parent, doc)
+            self.assertEqual(structure.datatype, expected_structure.datatype)
+            self.assertEqual(structure.name, expected_structure.name)
+        self.assertEqual(len(doc.references), 4)
+        with self.assertRaisesRegex(oddl.Error, r'\[7\.5\]'):
+            doc.loads('A {}\nB {}\nC {}\nD {}\n  C { D\n {u8 {1,\n 300}}}'
+                      '\nE {}', jobs=3)
+        with self.assertRaisesRegex(oddl.Error,
+                                    r'\[2\.6\]: .duplicate name \$a'):
+            doc.loads('A $a {}\n  B {C $a {}}', jobs=2)
+        text = 'X (p = ab//cd==) {}\nY {z {QU\n  JD, QQ==}}\n'
+        expected.loads(text)
+        doc.loads(text, jobs=2)
+        self.assertEqual(doc.dumps(), expected.dumps())
+        import bench
+        text = bench.generate('blob', 300_000)
+        expected.loads(text)
+        doc.loads(text, jobs=2)
+        self.assertEqual(doc.dumps(), expected.dumps())
+        text = 'A $a {}\n' + 'X {' * 3000 + '}' * 3000 + '\nB {X $b {}}'
+        expected.loads(text)
+        doc.loads(text, jobs=2)
+        self.assertEqual(doc.dumps(), expected.dumps())
+        self.assertIs(doc.global_names['$b'].parent, doc.structures[2])
+
+
+    def test_process(self):
+        filename = str(EG / 'GreenCube.oddl')
+        with unittest.mock.patch.dict(os.environ, ODDL_LINT_CACHE=''):
+            name, size, messages, ok = oddl.process('lint', filename)
+            self.assertEqual((name, messages, ok), (filename, [], True))
+            self.assertEqual(size, (EG / 'GreenCube.oddl').stat().st_size)
+            name, size, messages, ok = oddl.process('lint', filename + '.x')
+        self.assertFalse(ok)
+        self.assertEqual(len(messages), 1)
+
+
+    def test_write(self):
+        doc = oddl.Oddl(str(EG / 'GreenCube.oddl'))
+        text = doc.dumps()
+        self.assertIn('Metric (key = "distance")\n{\n    f32 {0.01}\n}\n',
+                      text)
+        self.assertIn('        f32[3] {{0, 1, 0}}\n', text)
+        copy = oddl.Oddl()
+        copy.loads(text)
+        self.assertEqual(copy.dumps(), text)
+        out = io.StringIO()
+        writer = oddl.Writer(out, chunksize=64)
+        doc.write(writer)
+        self.assertEqual(out.getvalue(), text)
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'cube.oddl')
+            doc.save(filename)
+            with open(filename, encoding='utf-8') as file:
+                self.assertEqual(file.read(), text)
+        doc.loads('''X (a = 0.1) {
+            float {0x7F800000, 0.1, 3.4028235e38} double {0.1, 1e300}
+            float[2]* {s {1, 2}, {3, 4}} string {"a\\n"} bool {true}
+            base64 {QUJD} type {float} ref {null, $a}}''')
+        self.assertEqual(doc.dumps(), '''\
+X (a = 0.1)
+{
+    f32 {0x7F800000, 0.1, 3.40282347e+38}
+    f64 {0.1, 1e+300}
+    f32[2]* {s {1, 2}, {3, 4}}
+    s {"a\\n"}
+    b {true}
+    z {QUJD}
+    t {f32}
+    r {null, $a}
+}
+''')
+
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'cube.oddl')
+            with open(EG / 'GreenCube.oddl', encoding='utf-8') as file:
+                text = file.read()
+            with open(filename, 'wt', encoding='utf-8') as file:
+                file.write(text + '\nX (a = 1, b = $a) {z {QUJD} '
+                           'u64 {18446744073709551615} f16[2]* %p {s {1, 2}}}')
+            doc = oddl.Oddl()
+            doc.load(filename, cache=True)
+            self.assertTrue(os.path.exists(filename + 'c'))
+            cached = oddl.Oddl()
+            cached.load(filename, cache=True)
+            self.assertEqual(cached.dumps(), doc.dumps())
+            self.assertEqual(len(cached.references), len(doc.references))
+            geometry = cached.global_names['$geometry1']
+            mesh = geometry.structures[0]
+            position = mesh.structures[0].structures[0]
+            self.assertIsInstance(position.data, memoryview)
+            self.assertEqual(position.view.shape, (24, 3))
+            x = cached.structures[-1]
+            self.assertIs(cached.resolve('%p', x), x.structures[2])
+            self.assertEqual(x.structures[2].states, ['s'])
+            self.assertEqual(x.properties['b'], '$a')
+            with open(filename, 'at', encoding='utf-8') as file:
+                file.write('\nY {}')
+            stale = oddl.Oddl()
+            stale.load(filename, cache=True)
+            self.assertEqual(stale.structures[-1].datatype, 'Y')
+            cache = oddl.Cache(filename)
+            self.assertTrue(cache.load(oddl.Oddl()))
+            os.truncate(filename + 'c', os.path.getsize(filename + 'c') - 8)
+            self.assertFalse(cache.load(oddl.Oddl()))
+            with open(filename + 'c', 'r+b') as file:
+                file.write(b'junk')
+            self.assertFalse(oddl.Cache(filename).load(stale))
+
+
+    def test_mapped(self):
+        for filename in sorted(EG.glob('*.oddl')):
+            text = oddl.Oddl(str(filename)).dumps()
+            for options in ({}, {'lazy': True}, {'jobs': 2}):
+                doc = oddl.Oddl()
+                doc.load(str(filename), mapped=True, **options)
+                self.assertEqual(doc.dumps(), text)
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'x.oddl')
+            with open(filename, 'wt', encoding='utf-8') as file:
+                file.write('X (a = "\u00e9") {s {"\u00fc" "b"}}\n' * 4)
+            doc = oddl.Oddl()
+            doc.load(filename, mapped=True, jobs=2)
+            self.assertEqual(len(doc.structures), 4)
+            self.assertEqual(doc.structures[3].properties['a'], '\u00e9')
+            self.assertEqual(doc.structures[3].structures[0].data,
+                             ['\u00fcb'])
+            with open(filename, 'wb') as file:
+                file.write(b'X {}\nY {s {"\xff"}}')
+            with self.assertRaisesRegex(oddl.Error, r'\[2\.8\].*UTF-8'):
+                doc.load(filename, mapped=True)
+
+
+    def test_select(self):
+        doc = oddl.Oddl(str(EG / 'GreenCube.oddl'))
+        found = doc.select(
+            'GeometryObject/Mesh/VertexArray[attrib="position"]')
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0].properties['attrib'], 'position')
+        for i in range(300):
+            doc.select(f'X{i}')
+        self.assertEqual(oddl.Query.get.cache_info().currsize, 256)
+        self.assertEqual([structure.properties['attrib'] for structure in
+                          doc.select('//VertexArray[attrib]')],
+                         ['position', 'normal', 'texcoord'])
+        self.assertEqual(len(doc.select('//Mesh//float')), 3)
+        self.assertEqual(len(doc.select('*')), 5)
+        self.assertEqual(len(doc.select('Metric[key="up"]/*')), 1)
+        self.assertEqual(doc.select('//Mesh[lod=0]'), [])
+        geometry = doc.global_names['$geometry1']
+        self.assertEqual(len(geometry.select('Mesh/VertexArray')), 3)
+        self.assertEqual(geometry.select('GeometryObject'), [])
+        mesh = doc.select('//Mesh')[0]
+        self.assertIsNotNone(doc._index)
+        mesh.structures.append(oddl.PrimitiveStructure(oddl.DataType('u8')))
+        self.assertIsNone(doc._index)
+        self.assertEqual(doc.select('//Mesh/u8')[0].parent, mesh)
+        mesh.properties['lod'] = 0
+        self.assertEqual(doc.select('//Mesh[lod=0]'), [mesh])
+        self.assertEqual(doc.select('//Mesh[lod=false]'), [])
+        for pattern in ('', 'Mesh/', 'Mesh[', 'Mesh[lod="0"'):
+            with self.assertRaises(oddl.Error):
+                doc.select(pattern)
+
+
+    def test_bench_corpora(self):
+        import bench
+        for kind in bench.KINDS:
+            text = bench.generate(kind, 20_000)
+            self.assertEqual(text, bench.generate(kind, 20_000))
+            self.assertGreaterEqual(len(text), 20_000)
+            doc = oddl.Oddl()
+            doc.loads(text)
+            copy = oddl.Oddl()
+            copy.loads(doc.dumps())
+            self.assertEqual(copy.dumps(), doc.dumps())
+
+
+    def test_stats(self):
+        events = []
+        stats = oddl.Stats(
+            on_start=lambda structure, depth: events.append(
+                ('start', structure.datatype, depth)),
+            on_end=lambda structure, depth: events.append(
+                ('end', structure.datatype, depth)))
+        doc = oddl.Oddl()
+        doc.load(str(EG / 'GreenCube.oddl'), stats=stats)
+        self.assertEqual(events[:4], [('start', 'Metric', 0),
+                                      ('start', 'f32', 1), ('end', 'f32', 1),
+                                      ('end', 'Metric', 0)])
+        self.assertEqual(stats.datatypes['VertexArray'], 3)
+        self.assertEqual(sum(stats.datatypes.values()), 28)
+        self.assertEqual(stats.max_depth, 3)
+        self.assertEqual(stats.tokens['{'], 28)
+        self.assertEqual(stats.tokens['Reference'], 2)
+        self.assertGreater(stats.tokens['number'], 200)
+        self.assertAlmostEqual(sum(stats.times.values()), stats.seconds)
+        self.assertGreater(stats.bytes_per_second, 0)
+        size = stats.size
+        doc.loads('A {B {}}', stats=stats)
+        self.assertEqual(stats.size, size + 8)
+        self.assertEqual(stats.datatypes['B'], 1)
+        self.assertIn('max depth 3', str(stats))
+        stats = oddl.Stats()
+        doc.loads('A {B {C {}}} D {}', lazy=True, stats=stats)
+        self.assertEqual(stats.datatypes, {'A': 1, 'B': 1, 'C': 1, 'D': 1})
+        self.assertFalse(doc.lazy)
+
+
+    def test_edit(self):
+        text = (EG / 'GreenCube.oddl').read_text(encoding='utf-8')
+        doc = oddl.Oddl()
+        doc.loads(text)
+        mesh = doc.select('//Mesh')[0]
+        start, end = mesh.source_span()
+        self.assertTrue(text[start:end].startswith('Mesh (primitive'))
+        self.assertTrue(text[start:end].endswith('}'))
+        material = doc.global_names['$material1']
+        material_start = material.source_span()[0]
+        offset = text.index('"triangles"') + 1
+        new = doc.edit(offset, len('triangles'), 'quads')
+        self.assertEqual(new.datatype, 'Mesh')
+        self.assertIs(doc.select('//Mesh')[0], new)
+        self.assertEqual(new.properties['primitive'], 'quads')
+        self.assertEqual(material.source_span()[0], material_start - 4)
+        name = doc.select('GeometryNode/Name')[0]
+        new = doc.edit(doc.source.index('"Cube"') + 1, 0, 'Green')
+        self.assertEqual(new.datatype, 's') # only the string was reparsed
+        self.assertIs(new.parent, name)
+        self.assertEqual(new.data, ['GreenCube'])
+        self.assertEqual(material.source_span()[0], material_start + 1)
+        offset = doc.source.index('$geometry1 ')
+        new = doc.edit(offset, len('$geometry1'), '$geometry2')
+        self.assertEqual(new.datatype, 'GeometryObject')
+        self.assertIs(doc.global_names['$geometry2'], new)
+        self.assertNotIn('$geometry1', doc.global_names)
+        self.assertIsNone(doc.resolve('$geometry1'))
+        copy = oddl.Oddl()
+        copy.loads(doc.source)
+        self.assertEqual(doc.dumps(), copy.dumps())
+        self.assertIsNone(doc.edit(len(doc.source), 0, '\nX {}'))
+        self.assertEqual(doc.structures[-1].datatype, 'X')
+        with self.assertRaises(oddl.Error):
+            doc.edit(0, 0, '{')
+        self.assertIsNone(doc.edit(0, 1, ''))
+        self.assertEqual(doc.dumps(), copy.dumps() + 'X {}\n')
+
+
+    def test_incremental_save(self):
+        text = (EG / 'GreenCube.oddl').read_text(encoding='utf-8')
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'cube.oddl')
+            for options in ({}, {'mapped': True}):
+                with open(filename, 'wt', encoding='utf-8') as file:
+                    file.write(text)
+                doc = oddl.Oddl()
+                doc.load(filename, **options)
+                self.assertFalse(doc.dirty)
+                doc.save(incremental=True)
+                with open(filename, encoding='utf-8') as file:
+                    self.assertEqual(file.read(), text) # nothing changed
+                metric = doc.select('Metric[key="distance"]/float')[0]
+                metric.datalist = [0.02]
+                os.chmod(filename, 0o640)
+                self.assertEqual(metric.dirty, oddl.DIRTY)
+                self.assertEqual(metric.parent.dirty, oddl.DIRTY_WITHIN)
+                self.assertFalse(doc.dirty)
+                doc.save(incremental=True)
+                with open(filename, encoding='utf-8') as file:
+                    self.assertEqual(file.read(), text.replace(
+                        '{float {0.01}}', '{f32 {0.02}}'))
+                self.assertEqual(os.stat(filename).st_mode & 0o777, 0o640)
+                # The file has changed so this save is a full save
+                doc.structures.append(oddl.DerivedStructure('Extra'))
+                self.assertTrue(doc.dirty)
+                doc.save(incremental=True)
+                with open(filename, encoding='utf-8') as file:
+                    self.assertEqual(file.read(), doc.dumps())
+            crlf = text.replace('\n', '\r\n')
+            for options in ({}, {'mapped': True}):
+                with open(filename, 'wb') as file:
+                    file.write(crlf.encode('utf-8'))
+                doc = oddl.Oddl()
+                doc.load(filename, **options)
+                material = doc.global_names['$material1']
+                material.properties['extra'] = True
+                doc.save(incremental=True)
+                with open(filename, 'rb') as file:
+                    data = file.read().decode('utf-8')
+                start = crlf.index('Material $material1')
+                self.assertEqual(data[:start], crlf[:start]) # copied as is
+                copy = oddl.Oddl()
+                copy.loads(data)
+                self.assertEqual(copy.dumps(), doc.dumps())
+        doc = oddl.Oddl()
+        doc.loads(text)
+        material = doc.global_names['$material1']
+        material.name = '$material2'
+        self.assertEqual(material.dirty, oddl.DIRTY)
+        doc.structures.insert(0, oddl.DerivedStructure('First'))
+        pieces = list(doc.pieces(len(doc.source)))
+        self.assertEqual(pieces[:2], ['First {}', '\n'])
+        self.assertEqual([piece for piece in pieces[2:]
+                          if isinstance(piece, str) and piece.strip()],
+                         ['Material $material2\n{'])
+        copy = oddl.Oddl()
+        copy.loads(''.join(text[piece[0]:piece[1]] if isinstance(
+            piece, tuple) else piece for piece in pieces))
+        self.assertEqual(copy.dumps(), doc.dumps())
+        # Only the header of a renamed structure is written so the text of
+        # its unchanged children is kept
+        commented = ('GeometryObject $g // keep me\n{\n'
+                     '    Mesh {// big payload\n'
+                     '        float[3] {{1, 2, 3},\n'
+                     '                  {4, 5, 6}}\n'
+                     '    }\n}\n')
+
+        def saved(doc):
+            return ''.join(commented[piece[0]:piece[1]]
+                           if isinstance(piece, tuple) else piece
+                           for piece in doc.pieces(len(commented)))
+
+        doc = oddl.Oddl()
+        doc.loads(commented)
+        doc.global_names['$g'].name = '$h'
+        self.assertEqual(saved(doc), commented.replace(
+            '$g // keep me\n{', '$h\n{'))
+        structures = doc.structures[0].structures
+        structures.append(oddl.DerivedStructure('Extra'))
+        structures.insert(0, oddl.DerivedStructure('New'))
+        self.assertEqual(saved(doc), commented.replace(
+            '$g // keep me\n{', '$h\n{\n    New {}').replace(
+            '    }\n}', '    }\n    Extra {}\n}'))
+        del structures[1] # its text can't be told from the rest
+        self.assertEqual(saved(doc),
+                         'GeometryObject $h\n{\n    New {}\n    Extra {}\n}\n')
+        for attribute, value in (('data', [1.0] * 72),
+                                 ('dataarraylistsize', 6), ('states', None)):
+            doc = oddl.Oddl()
+            doc.loads(text)
+            positions = doc.select('//VertexArray/float')[0]
+            setattr(positions, attribute, value)
+            self.assertEqual(positions.dirty, oddl.DIRTY)
+            self.assertEqual(positions.parent.dirty, oddl.DIRTY_WITHIN)
+            pieces = [piece for piece in doc.pieces(len(doc.source))
+                      if isinstance(piece, str)]
+            self.assertEqual(len(pieces), 1)
+            self.assertTrue(pieces[0].startswith('f32['))
+
+
+    def test_async(self):
+        filenames = sorted(str(filename) for filename in EG.glob('*.oddl'))
+
+        async def main(path):
+            docs = [oddl.Oddl() for _ in filenames]
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                await asyncio.gather(*(
+                    doc.aload(filename, executor=executor)
+                    for doc, filename in zip(docs, filenames)))
+            for doc, filename in zip(docs, filenames):
+                self.assertEqual(doc.dumps(), oddl.Oddl(filename).dumps())
+                self.assertIs(doc.structures[0].parent, doc)
+            filename = os.path.join(path, 'cube.oddl')
+            await docs[-1].asave(filename, semaphore=asyncio.Semaphore(1))
+            with open(filename, encoding='utf-8') as file:
+                self.assertEqual(file.read(), docs[-1].dumps())
+            doc = oddl.Oddl()
+            datatypes = [structure.datatype async for structure in
+                         doc.astructures(filename, chunksize=64)]
+            self.assertEqual(datatypes, [structure.datatype for structure
+                                         in docs[-1].structures])
+            self.assertEqual(doc.structures, [])
+            with self.assertRaises(oddl.Error):
+                with open(filename, 'at', encoding='utf-8') as file:
+                    file.write('{')
+                await doc.aload(filename)
+
+        async def deep(filename):
+            doc = oddl.Oddl()
+            with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                await doc.aload(filename, executor=executor)
+            return doc
+
+        with tempfile.TemporaryDirectory() as path:
+            asyncio.run(main(path))
+            filename = os.path.join(path, 'deep.oddl')
+            with open(filename, 'wt', encoding='utf-8') as file:
+                file.write('X {' * 3000 + 'u8 {1}' + '}' * 3000)
+            doc = asyncio.run(deep(filename))
+            self.assertEqual(doc.dumps(), oddl.Oddl(filename).dumps())
+
+
+    def test_lazy_base64(self):
+        doc = oddl.Oddl()
+        doc.loads('X (p = QUJD) {z {QU\n  JD, QQ==}}')
+        first, second = doc.structures[0].structures[0].data
+        self.assertFalse(first.decoded)
+        self.assertEqual(doc.dumps(), 'X (p = QUJD)\n{\n    z {QU\n  JD, '
+                         'QQ==}\n}\n')
+        self.assertFalse(first.decoded)
+        self.assertEqual(bytes(first), b'ABC')
+        self.assertTrue(first.decoded)
+        self.assertEqual(second, oddl.Base64Data.frombytes(b'A'))
+        p = doc.structures[0].properties['p']
+        self.assertEqual(hash(p), hash(first))
+        self.assertFalse(p.decoded)
+        self.assertEqual(hash(oddl.Base64Data('QR ==')), hash(second))
+        self.assertEqual(hash(oddl.Base64Data.frombytes(b'ABC')), hash(p))
+        for text in ('X {z {QQ=}}', 'X {z {QUJDQ}}', 'X (p = QQ=) {}'):
+            with self.assertRaises(oddl.Error):
+                oddl.Oddl().loads(text)
+
+
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() + 100
+        text = '// comment\n' * 10_000 + 'X {' * depth + 'u8 {1}' + \
+            '}' * depth
+        doc = oddl.Oddl()
+        stats = oddl.Stats()
+        doc.loads(text, stats=stats)
+        self.assertEqual(stats.max_depth, depth)
+        structure = doc.structures[0]
+        for _ in range(depth):
+            structure = structure.structures[0]
+        self.assertEqual(structure.data.tolist(), [1])
+        copy = oddl.Oddl()
+        copy.loads(doc.dumps())
+        self.assertEqual(copy.dumps(), doc.dumps())
+        structure.datalist = [2]
+        pieces = list(doc.pieces(len(text)))
+        self.assertEqual(pieces.count('u8 {2}'), 1)
+        self.assertEqual(len(pieces), 2 * depth + 3)
+
+
+    def test_check(self):
+        doc = oddl.Oddl()
+        doc.loads('X $a (p = $a, q = %y) {Y %y {} ref {$a, null, %y}\n'
+                  'u8[2]* {s {1, 2}, {3, 4}} f16 {1.5}}')
+        self.assertEqual(doc.check(), [])
+        x = doc.structures[0]
+        x.properties['p'] = oddl.Reference('$none')
+        y, refs, pairs, halves = x.structures
+        y.name = '%y'
+        x.structures.append(oddl.DerivedStructure('Y'))
+        with self.assertRaisesRegex(oddl.Error, 'duplicate name %y'):
+            x.structures[-1].name = '%y'
+        x.structures[-1]._name = '%y' # as if the tables were bypassed
+        pairs.states = ['s', '1']
+        halves.data = oddl.array.array('f', [1e6])
+        refs.data.append(oddl.Reference('%none'))
+        ints = oddl.PrimitiveStructure('u8')
+        ints.dataarraylistsize = 2
+        ints.data = [1, 2, 300]
+        x.structures.append(ints)
+        self.assertEqual(doc.check(), [
+            "ERROR: X $a/u8: \"invalid state marker '1'\"",
+            "ERROR: X $a/f16: 'value 1000000.0 out of range for f16'",
+            "ERROR: X $a/Y %y: 'duplicate name %y'",
+            "ERROR: X $a/u8: '3 data array elements is not a multiple of "
+            "the array size 2'",
+            "ERROR: X $a/u8: 'value 300 is not valid u8 data'",
+            "ERROR: X $a: 'unresolved reference $none'",
+            "ERROR: X $a/r: 'unresolved reference %none'"])
+        # References are resolved against the names in the tree itself
+        doc = oddl.Oddl()
+        doc.loads((EG / 'GreenCube.oddl').read_text(encoding='utf-8'))
+        doc.global_names['$material1'].name = '$material2'
+        self.assertEqual(doc.check(), [
+            "ERROR: GeometryNode $node1/MaterialRef/r: "
+            "'unresolved reference $material1'"])
+        doc.global_names['$material2']._name = '$material3'
+        doc.structures[-1].structures[0]._name = '%name'
+        doc.select('//MaterialRef/ref')[0].data = [
+            oddl.Reference('$material2'), oddl.Reference('$material3%name')]
+        self.assertEqual(doc.check(), [
+            "ERROR: GeometryNode $node1/MaterialRef/r: "
+            "'unresolved reference $material2'"])
+
+
+    def test_lint_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'x.oddl')
+            cache = os.path.join(path, 'cache')
+            with open(filename, 'wt', encoding='utf-8') as file:
+                file.write('X {ref {$a}}')
+            ok, messages = oddl.lint_file(filename, cache)
+            self.assertFalse(ok)
+            self.assertEqual(len(messages), 1)
+            self.assertIn('unresolved reference $a', messages[0])
+            key, = os.listdir(cache)
+            lint_cache = oddl.LintCache(cache)
+            lint_cache.put(key, True, ['cached'])
+            self.assertEqual(oddl.lint_file(filename, cache),
+                             (True, ['cached']))
+            self.assertEqual(oddl.lint_file(filename, False)[0], False)
+            with open(filename, 'at', encoding='utf-8') as file:
+                file.write(' Y $a {}')
+            self.assertEqual(oddl.lint_file(filename, cache), (True, []))
+            self.assertEqual(len(os.listdir(cache)), 2)
+            with open(filename, 'at', encoding='utf-8') as file:
+                file.write(' {')
+            ok, messages = oddl.lint_file(filename, cache)
+            self.assertFalse(ok)
+            self.assertIn('ERROR:', messages[0])
+
+
+    def test_compressed(self):
+        doc = oddl.Oddl(str(EG / 'GreenCube.oddl'))
+        text = doc.dumps()
+        with tempfile.TemporaryDirectory() as path:
+            for suffix in ('.gz', '.bz2', '.xz'):
+                filename = os.path.join(path, 'x.oddl' + suffix)
+                doc.save(filename, incremental=True)
+                with open(filename, 'rb') as file:
+                    self.assertNotEqual(file.read(1), b'G')
+                copy = oddl.Oddl(filename)
+                self.assertEqual(copy.dumps(), text)
+                self.assertIsNone(copy._source_file)
+                stats = oddl.Stats()
+                copy.load(filename, stats=stats)
+                self.assertEqual(stats.size, len(text))
+                self.assertGreater(stats.seconds, 0.0)
+                self.assertEqual(stats.datatypes['Mesh'], 1)
+                events = list(copy.iterparse(filename, events={'start'}))
+                self.assertEqual(len(events), 28)
+            filename = os.path.join(path, 'x.oddl') # magic bytes not name
+            os.rename(filename + '.xz', filename)
+            self.assertEqual(oddl.Oddl(filename).dumps(), text)
+            with open(filename, 'r+b') as file:
+                file.truncate(100)
+            with self.assertRaisesRegex(oddl.Error, 'compressed'):
+                oddl.Oddl(filename)
+
+
+    def test_numpy(self):
+        doc = oddl.Oddl()
+        doc.loads('A {f32[3] {{1, 2, 3}, {4, 5, 6}}} B {u16 {7, 8}}\n'
+                  'A {f32[3] {{0, 0, 0}} f16[2] {{1.5, 2}} b {true}}')
+        first = doc.structures[0].structures[0]
+        if oddl.numpy is None:
+            with self.assertRaisesRegex(oddl.Error, 'NumPy'):
+                first.numpy()
+            return
+        array = first.numpy()
+        self.assertEqual((array.shape, array.dtype.name), ((2, 3),
+                                                           'float32'))
+        array[0, 0] = 99 # shares the data's buffer
+        self.assertEqual(first.data[0], 99)
+        self.assertEqual(doc.numpy('A/f32').tolist(),
+                         [[99, 2, 3], [4, 5, 6], [0, 0, 0]])
+        self.assertEqual(doc.numpy('//f16').dtype.name, 'float16')
+        self.assertEqual(doc.numpy('//b').tolist(), [True])
+        with self.assertRaises(oddl.Error):
+            doc.numpy('A/*')
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'x.npz')
+            doc.export_numpy(filename)
+            with oddl.numpy.load(filename) as arrays:
+                self.assertEqual(sorted(arrays.files), [
+                    'A/b', 'A/f16', 'A/f32', 'A/f32#2', 'B/u16'])
+                self.assertEqual(arrays['B/u16'].tolist(), [7, 8])
+            filename = os.path.join(path, 'x.npy')
+            doc.export_numpy(filename, 'A/f32')
+            self.assertEqual(oddl.numpy.load(filename).shape, (3, 3))
+        # Long runs of floats are converted by NumPy
+        values = [i / 8 for i in range(20_000)]
+        run = ', '.join(map(str, values))
+        self.assertGreater(len(run), oddl.NUMPY_THRESHOLD)
+        rows = ', '.join(f'{{{x}, {y}}}'
+                         for x, y in zip(values[::2], values[1::2]))
+        doc.loads(f'f32 {{{run}}} f64[2] {{{rows}}}')
+        self.assertEqual(doc.structures[0].data,
+                         oddl.array.array('f', values))
+        self.assertEqual(doc.structures[1].data.tolist(), values)
+
+
+    def test_digest_diff(self):
+        text = ('A $a (k = 1) {B {u8 {1, 2}} C {s {"x"}}}\n'
+                'A $b (k = 1) {B {u8 {1, 2}} C {s {"x"}}}\n'
+                'D {f32[2] {{1, 2}}}')
+        old = oddl.Oddl()
+        old.loads(text)
+        new = oddl.Oddl()
+        new.loads(text)
+        a, b, d = new.structures
+        self.assertEqual(old.digest(), new.digest())
+        self.assertNotEqual(a.digest(), b.digest()) # names differ
+        self.assertEqual(a.content_digest(), b.content_digest())
+        self.assertEqual(a.structures[0].digest(), b.structures[0].digest())
+        self.assertEqual(new.diff(old), [])
+        digest = b.digest()
+        b.structures[1].structures[0].datalist = ['y']
+        self.assertNotEqual(b.digest(), digest)
+        self.assertIsNone(new._digest)
+        a.properties['k'] = oddl.Int(2)
+        new.structures.append(oddl.DerivedStructure('E'))
+        del new.structures[2]
+        differences = [(kind, (old or new).path()) for kind, old, new in
+                       old.diff(new)]
+        self.assertEqual(differences, [('changed', 'A $a'),
+                                       ('changed', 'A $b/C/s'),
+                                       ('removed', 'D'),
+                                       ('added', 'E')])
+        groups = old.duplicates()
+        self.assertEqual([[s.path() for s in group] for group in groups],
+                         [['A $a/B/u8', 'A $b/B/u8'],
+                          ['A $a/C/s', 'A $b/C/s']])
+        self.assertEqual(len(old.duplicates('A')), 1)
+        first, second = old.structures[0].digest(), old.structures[1].digest()
+        old.edit(text.index('u8 {1') + 4, 1, '9')
+        self.assertNotEqual(old.structures[0].digest(), first)
+        self.assertEqual(old.structures[1].digest(), second)
+        old.loads(text)
+        new.loads(text)
+        self.assertEqual(old.diff(new), [])
+        new.structures[2].name = '$d' # a rename is seen without touch()
+        differences = [(kind, (old or new).path()) for kind, old, new in
+                       old.diff(new)]
+        self.assertEqual(differences, [('removed', 'D'), ('added', 'D $d')])
+        # So are changes to data-types and to whether there are states
+        new.loads(text)
+        u8 = new.structures[0].structures[0].structures[0]
+        digest = u8.digest()
+        u8.datatype = oddl.DataType('u16')
+        self.assertEqual(u8.dirty, oddl.DIRTY)
+        self.assertNotEqual(u8.digest(), digest)
+        f32 = new.structures[2].structures[0]
+        f32.dataarrayliststates = True
+        f32.states = [None]
+        self.assertEqual([(kind, (old or new).path()) for kind, old, new in
+                          old.diff(new)],
+                         [('removed', 'A $a/B/u8'), ('added', 'A $a/B/u16'),
+                          ('changed', 'D/f32')])
+        self.assertEqual(len(new.select('//B')), 2)
+        new.structures[1].structures[0].datatype = 'Z'
+        self.assertEqual(new.select('//Z'), [new.structures[1].structures[0]])
+
+
+    def test_compact_nodes(self):
+        doc = oddl.Oddl()
+        doc.loads('A {float {1}} B (key = 1) {} C {D %d {}}')
+        a, b, c = doc.structures
+        for structure in (a, a.structures[0]):
+            self.assertFalse(hasattr(structure, '__dict__'))
+        self.assertIsNone(a._properties)
+        self.assertIsNone(a._local_names)
+        self.assertIsNone(b._structures)
+        self.assertIn('B (key = 1) {}', doc.dumps())
+        self.assertIsNone(b._structures)
+        self.assertIs(c.lookup('%d'), c.structures[0])
+        self.assertEqual(b.properties, {'key': 1})
+        self.assertIs(oddl.DataType('float'), oddl.DataType('f32'))
+        self.assertIs(a.structures[0].datatype, oddl.DataType('f'))
+
+
+    def test_errors(self):
+        for text in ('X {', 'x1 {}', 'X {u8 {256}}', 'X {float[2] {{1}}}',
+                     'X { /* '):
+            with self.assertRaises(oddl.Error):
+                oddl.Oddl().loads(text)
+        with self.assertRaisesRegex(oddl.Error, r'\[4\.5\]'):
+            oddl.Oddl().loads('X {\n// 300\n  u8 {1,\n 300}}')
+        for text in ('u8 {1, 2,}', 's {"a",}', 'u8[1] {{1},}',
+                     'u8 {1, 2, /* */ }', 'u8[1] {{1,}}'):
+            with self.assertRaisesRegex(oddl.Error, "after ','"):
+                oddl.Oddl().loads(text)
+        doc = oddl.Oddl()
+        doc.loads('u8 {} u8[2] {} s {"a"}')
+        self.assertEqual(doc.dumps(), 'u8 {}\nu8[2] {}\ns {"a"}\n')
+
+
+    def test_location(self):
+        lexer = oddl.Lexer('ab\ncd\n\nef', lino=10)
+        self.assertEqual(lexer.location(0), (10, 1))
+        self.assertEqual(lexer.location(2), (10, 3))
+        self.assertEqual(lexer.location(3), (11, 1))
+        self.assertEqual(lexer.location(6), (12, 1))
+        self.assertEqual(lexer.location(8), (13, 2))
+
+
 if __name__ == '__main__':
     unittest.main()